@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the conversion and update hot paths.
+
+Run them from the repository root against a throwaway test database::
+
+    $ python benchmarks/run.py --output results.json
+    $ python benchmarks/run.py --compare results.json --max-regression 20
+
+Use `--settings` to point to a settings module with another database (e.g.
+a PostgreSQL running in a container). All the reported metrics are "lower
+is better" so that results of two commits can be compared directly.
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import json
+import os
+import platform
+import random
+import string
+import subprocess
+import sys
+import time
+from decimal import Decimal
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _make_currencies(count):
+    """
+    Return 'count' currency codes, the ones known to moneyed first
+    """
+    import moneyed
+
+    codes = sorted(moneyed.CURRENCIES)
+    alphabet = string.digits + string.ascii_uppercase
+    fake_codes = ("Q%s%s" % (a, b) for a in alphabet for b in alphabet)
+    while len(codes) < count:
+        code = next(fake_codes)
+        if code not in moneyed.CURRENCIES:
+            codes.append(code)
+    return codes[:count]
+
+
+CURRENCIES = _make_currencies(1000)
+
+
+def make_backend(size, step=0):
+    """
+    Return a backend providing 'size' currencies, with values depending on 'step'
+    """
+    from djmoney_rates.backends import BaseRateBackend
+
+    class BenchmarkBackend(BaseRateBackend):
+        source_name = "benchmark-%d" % size
+        base_currency = CURRENCIES[0]
+
+        def get_rates(self):
+            return dict((currency, Decimal(i + 1 + step) / 7) for i, currency in enumerate(CURRENCIES[:size]))
+
+    return BenchmarkBackend
+
+
+def count_queries(func):
+    """
+    Call 'func' and return its wall time and the number of queries it issued
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    with CaptureQueriesContext(connection) as ctx:
+        started_at = time.time()
+        func()
+        elapsed = time.time() - started_at
+    return elapsed, len(ctx.captured_queries)
+
+
+def use_backend(backend_class):
+    from djmoney_rates.settings import money_rates_settings
+
+    money_rates_settings.DEFAULT_BACKEND = backend_class
+    backend_class().update_rates()
+
+
+def bench_conversion(iterations=20000, size=170):
+    """
+    Throughput and queries of base_convert_money in steady state and with a cold cache
+    """
+    from djmoney_rates.cache import rate_cache
+    from djmoney_rates.utils import base_convert_money
+
+    use_backend(make_backend(size))
+    rng = random.Random(0)
+    pairs = [(rng.choice(CURRENCIES[:size]), rng.choice(CURRENCIES[:size])) for _ in range(iterations)]
+
+    rate_cache.invalidate()
+    cold_time, cold_queries = count_queries(lambda: base_convert_money(Decimal("10.50"), *pairs[0]))
+
+    def convert_all():
+        for currency_from, currency_to in pairs:
+            base_convert_money(Decimal("10.50"), currency_from, currency_to)
+
+    elapsed, queries = count_queries(convert_all)
+    return {
+        "us_per_conversion": elapsed / iterations * 1e6,
+        "queries_per_conversion": float(queries) / iterations,
+        "cold_queries": cold_queries,
+        "cold_ms": cold_time * 1e3,
+    }
+
+
+def bench_conversion_many(iterations=100000, size=170):
+    """
+    Throughput of convert_money_many over a large batch
+    """
+    from djmoney_rates.utils import convert_money_many
+
+    use_backend(make_backend(size))
+    rng = random.Random(0)
+    amounts = [Decimal(rng.randint(1, 10 ** 6)) / 100 for _ in range(iterations)]
+    currencies_from = [rng.choice(CURRENCIES[:size]) for _ in range(iterations)]
+
+    elapsed, queries = count_queries(
+        lambda: convert_money_many(amounts, currencies_from, CURRENCIES[1], as_decimal=True))
+    return {
+        "us_per_conversion": elapsed / iterations * 1e6,
+        "queries": queries,
+    }
+
+
+def bench_conversion_minor_units(iterations=100000, size=170):
+    """
+    Throughput of the integer path against the Decimal path on the same batch
+    """
+    from djmoney_rates.utils import convert_minor_units_many, convert_money_many
+
+    use_backend(make_backend(size))
+    rng = random.Random(0)
+    minor_amounts = [rng.randint(1, 10 ** 6) for _ in range(iterations)]
+    amounts = [Decimal(amount) / 100 for amount in minor_amounts]
+    currency_from, currency_to = CURRENCIES[2], CURRENCIES[1]
+
+    decimal_time, _ = count_queries(
+        lambda: convert_money_many(amounts, currency_from, currency_to, as_decimal=True))
+    integer_time, _ = count_queries(
+        lambda: convert_minor_units_many(minor_amounts, currency_from, currency_to))
+    return {
+        "us_per_conversion": integer_time / iterations * 1e6,
+        "decimal_us_per_conversion": decimal_time / iterations * 1e6,
+    }
+
+
+def bench_update_rates(size):
+    """
+    Wall time and queries of update_rates creating, changing and keeping 'size' rates
+    """
+    from djmoney_rates.models import RateSource
+
+    results = {}
+    RateSource.objects.filter(name=make_backend(size).source_name).delete()
+    for name, step in (("create", 0), ("change", 1), ("unchanged", 1)):
+        backend = make_backend(size, step)()
+        elapsed, queries = count_queries(backend.update_rates)
+        results["%s_ms" % name] = elapsed * 1e3
+        results["%s_queries" % name] = queries
+    return results
+
+
+def make_ecb_history(path, days, size=30):
+    """
+    Write an ECB history file with 'days' days of 'size' currencies
+    """
+    import datetime
+
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<Envelope><Cube>\n')
+        for day in range(days):
+            f.write('<Cube time="%s">' % (datetime.date(2000, 1, 1) + datetime.timedelta(days=day)))
+            for i, currency in enumerate(CURRENCIES[1:size + 1]):
+                f.write('<Cube currency="%s" rate="%s"/>' % (currency, Decimal(i + day % 7 + 1) / 7))
+            f.write('</Cube>\n')
+        f.write('</Cube></Envelope>\n')
+
+
+def bench_history_load(days=3650):
+    """
+    Wall time and queries of loading 'days' days of ECB rates into the history
+    """
+    import tempfile
+
+    from djmoney_rates.backends import ECBXMLFileBackend
+
+    handle, path = tempfile.mkstemp(suffix=".xml")
+    os.close(handle)
+    try:
+        make_ecb_history(path, days)
+        backend = ECBXMLFileBackend(path)
+        elapsed, queries = count_queries(lambda: backend.save_history(backend.iter_rates()))
+    finally:
+        os.remove(path)
+
+    return {
+        "ms": elapsed * 1e3,
+        "queries": queries,
+    }
+
+
+def bench_memory(iterations=1000, size=170):
+    """
+    Memory allocated by convert_money, measured with tracemalloc
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        return {}
+
+    from djmoney_rates.utils import convert_money
+
+    use_backend(make_backend(size))
+    convert_money(Decimal("10.50"), CURRENCIES[1], CURRENCIES[2])
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        for _ in range(iterations):
+            convert_money(Decimal("10.50"), CURRENCIES[1], CURRENCIES[2])
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename') if stat.size_diff > 0)
+    return {
+        "bytes_retained_per_conversion": float(allocated) / iterations,
+        "peak_kib": peak / 1024.0,
+    }
+
+
+def run_all(quick=False):
+    """
+    Run all the benchmarks and return their results keyed by name
+    """
+    scale = 10 if quick else 1
+    results = {
+        "conversion": bench_conversion(iterations=20000 // scale),
+        "conversion_many": bench_conversion_many(iterations=100000 // scale),
+        "conversion_minor_units": bench_conversion_minor_units(iterations=100000 // scale),
+        "convert_money_memory": bench_memory(iterations=1000 // scale),
+    }
+    for size in (50, 200, 1000):
+        results["update_rates_%d" % size] = bench_update_rates(size)
+    results["history_load"] = bench_history_load(days=3650 // scale)
+    return results
+
+
+def get_metadata():
+    import django
+    from django.db import connection
+
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.STDOUT).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "database": connection.vendor,
+        "timestamp": int(time.time()),
+    }
+
+
+def compare(results, baseline):
+    """
+    Return a list of `(benchmark, metric, baseline, current, change)` for the
+    metrics found in both results, change being the relative increase.
+    """
+    rows = []
+    for name, metrics in sorted(results.items()):
+        for metric, value in sorted(metrics.items()):
+            base = baseline.get(name, {}).get(metric)
+            if base is None:
+                continue
+            if base:
+                change = (value - base) / float(base)
+            else:
+                change = float("inf") if value > 0 else 0.0
+            rows.append((name, metric, base, value, change))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--settings", default="tests.settings", help="Django settings module")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    parser.add_argument("--max-regression", type=float, default=None,
+                        help="Exit with an error if a metric grows more than this percentage")
+    parser.add_argument("--quick", action="store_true", help="Run fewer iterations")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, ROOT)
+    os.environ["DJANGO_SETTINGS_MODULE"] = args.settings
+
+    import django
+    django.setup()
+
+    from django.db import connection
+
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        output = {"meta": get_metadata(), "results": run_all(quick=args.quick)}
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    dump = json.dumps(output, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(dump)
+    else:
+        print(dump)
+
+    if not args.compare:
+        return 0
+
+    with open(args.compare) as f:
+        baseline = json.load(f)["results"]
+
+    regressions = []
+    for name, metric, base, value, change in compare(output["results"], baseline):
+        print("%-24s %-32s %12.3f %12.3f %+8.1f%%" % (name, metric, base, value, change * 100), file=sys.stderr)
+        if args.max_regression is not None and change * 100 > args.max_regression:
+            regressions.append("%s.%s" % (name, metric))
+
+    if regressions:
+        print("Regressions: %s" % ", ".join(regressions), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
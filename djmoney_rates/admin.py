@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Rate, RateSource
+from .models import HistoricalRate, Rate, RateSource
 
 
 class RateInline(admin.TabularInline):
@@ -13,3 +13,12 @@ class RateSourceAdmin(admin.ModelAdmin):
 
 
 admin.site.register(RateSource, RateSourceAdmin)
+
+
+class HistoricalRateAdmin(admin.ModelAdmin):
+    list_display = ('currency', 'value', 'effective_at', 'source')
+    list_filter = ('source', 'currency')
+    date_hierarchy = 'effective_at'
+
+
+admin.site.register(HistoricalRate, HistoricalRateAdmin)
@@ -0,0 +1,74 @@
+"""
+Conversion utilities for asynchronous code.
+
+Rates found in the in-process cache (or in the current `rates_snapshot`)
+are used directly on the event loop, so that the common case completes
+without dispatching anything to a thread. Only loading the rates, which
+needs the database, runs in a thread.
+
+This module requires Python 3.7 or later, or asgiref.
+"""
+import asyncio
+import functools
+
+from .cache import rate_cache
+from .utils import base_convert_money, get_cached_rates, get_converter, get_source_names
+
+import moneyed
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    import contextvars
+
+    def sync_to_async(func):
+        """
+        Run 'func' in the default executor, preserving the context variables
+        """
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            context = contextvars.copy_context()
+            call = functools.partial(context.run, func, *args, **kwargs)
+            return await asyncio.get_event_loop().run_in_executor(None, call)
+        return wrapper
+
+
+async def aget_cached_rates(source=None):
+    """Return the cached rates of the Rate Source, see `get_cached_rates`."""
+    source_names = get_source_names(source)
+    if len(source_names) == 1:
+        rates = rate_cache.peek(source_names[0])
+    else:
+        rates = rate_cache.peek_merged(source_names)
+
+    if rates is None:
+        rates = await sync_to_async(get_cached_rates)(source)
+    return rates
+
+
+async def aget_rate(currency, source=None):
+    """Returns the rate from the default currency to `currency`."""
+    rates = await aget_cached_rates(source)
+    return rates.get_rate(currency)
+
+
+async def abase_convert_money(amount, currency_from, currency_to, at=None, source=None):
+    """
+    Convert 'amount' from 'currency_from' to 'currency_to' using the latest
+    rates, or the rates valid at the moment 'at' if given.
+    """
+    if at is not None:
+        # Historical rates are always read from the database
+        return await sync_to_async(base_convert_money)(amount, currency_from, currency_to, at, source)
+
+    rates = await aget_cached_rates(source)
+    return get_converter(rates, currency_from, currency_to)(amount)
+
+
+async def aconvert_money(amount, currency_from, currency_to, at=None, source=None):
+    """
+    Convert 'amount' from 'currency_from' to 'currency_to' and return a Money
+    instance of the converted amount.
+    """
+    new_amount = await abase_convert_money(amount, currency_from, currency_to, at, source)
+    return moneyed.Money(new_amount, currency_to)
@@ -1,27 +1,51 @@
 from __future__ import unicode_literals
 
+import contextlib
+import csv
+import datetime
+import gzip
 import logging
 import json
+import mmap
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from decimal import Decimal
+from xml.etree import ElementTree
 
+from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, router, transaction
+from django.utils import timezone
 from django.utils import six
 
-try:
-    from urllib2 import urlopen
-except ImportError:
-    from urllib.request import urlopen
-
+from . import metrics
 from .exceptions import RateBackendError
-from .models import RateSource, Rate
+from .http import http_request
+from .models import HistoricalRate, RateSource, Rate
 from .settings import money_rates_settings
+from .signals import rates_updated
 
 
 logger = logging.getLogger(__name__)
 
 
+# Rates written by `BaseRateBackend.update_rates`: 'created' and 'removed'
+# map currency codes to their rate, 'updated' to an `(old, new)` pair of rates
+RateChanges = namedtuple('RateChanges', ['created', 'updated', 'removed'])
+
+# Counters returned by `BaseRateBackend.update_rates`, with the `RateChanges`
+RatesUpdate = namedtuple('RatesUpdate', ['created', 'updated', 'unchanged', 'removed', 'changes'])
+
+
 class BaseRateBackend(object):
     source_name = None
     base_currency = None
+    # Seconds allowed to retrieve the rates, defaults to RATE_FETCH_TIMEOUT
+    timeout = None
+    # RateSource fields describing the retrieved rates, set by `get_rates`
+    validators = {}
 
     def get_source_name(self):
         """
@@ -45,26 +69,293 @@ class BaseRateBackend(object):
 
     def get_rates(self):
         """
-        Return a dictionary that maps currency code with its rate value
+        Return a dictionary that maps currency code with its rate value,
+        or None if the rates did not change since they were last saved
         """
         raise NotImplementedError
 
+    def get_historical_rates(self, start, end):
+        """
+        Yield the `(date, rates)` pairs of the days from 'start' to 'end',
+        both included, for the `backfill_rates` command
+        """
+        raise NotImplementedError
+
+    def is_history_streamed(self):
+        """
+        Return True when `get_historical_rates` reads a single stream holding
+        every date whatever the range, e.g. a file with the whole history, so
+        that `backfill_rates` reads it once instead of once per chunk
+        """
+        return False
+
+    def get_timeout(self):
+        """
+        Return the seconds `get_rates` is allowed to take
+        """
+        if self.timeout is not None:
+            return self.timeout
+        return money_rates_settings.RATE_FETCH_TIMEOUT
+
     def update_rates(self):
         """
-        Creates or updates rates for a source
+        Creates or updates rates for a source and return a `RatesUpdate`
+        with the number of created, updated, unchanged and removed rates,
+        or None when the rates did not change since the last update.
         """
-        source, created = RateSource.objects.get_or_create(name=self.get_source_name())
-        source.base_currency = self.get_base_currency()
-        source.save()
+        rates = self.measure_get_rates()
+        if rates is None:
+            logger.debug("Rates for %s are not modified", self.get_source_name())
+            return None
+        return self.save_rates(rates)
 
-        for currency, value in six.iteritems(self.get_rates()):
-            try:
-                rate = Rate.objects.get(source=source, currency=currency)
-            except Rate.DoesNotExist:
-                rate = Rate(source=source, currency=currency)
+    def measure_get_rates(self):
+        """
+        Call `get_rates` emitting its metrics
+        """
+        with metrics.measure('update_rates.fetch', source=self.get_source_name()):
+            return self.get_rates()
+
+    def update_source(self, source):
+        """
+        Set additional data of the retrieved rates on 'source' before it is saved
+        """
+        for name, value in six.iteritems(self.validators):
+            setattr(source, name, value)
+
+    def save_rates(self, rates):
+        """
+        Creates or updates the source with the given rates and return a
+        `RatesUpdate` with the number of created, updated, unchanged and
+        removed rates.
+
+        Only the difference with the stored rates is written: rates whose
+        value changed less than `RATE_CHANGE_EPSILON` are not written at
+        all and currencies missing from 'rates' are deleted. The difference
+        is sent as the `changes` argument of `rates_updated`.
+        """
+        with metrics.measure('update_rates.write', count_queries=True,
+                             source=self.get_source_name()) as measure:
+            result = self._save_rates(rates)
+            measure.data.update(created=result.created, updated=result.updated,
+                                unchanged=result.unchanged, removed=result.removed)
+        return result
+
+    def _save_rates(self, rates):
+        effective_at = timezone.now()
+
+        # Readers use the source last update as the version of its rates,
+        # so they must never see it changed before all the rates are written.
+        with transaction.atomic():
+            source, created = RateSource.objects.get_or_create(name=self.get_source_name())
+            source.base_currency = self.get_base_currency()
+            self.update_source(source)
+            source.save()
+
+            existing = dict((rate.currency, rate) for rate in Rate.objects.filter(source=source))
+            changes = RateChanges(created={}, updated={}, removed={})
+            new_rates, changed_rates = [], []
+
+            for currency, value in six.iteritems(rates):
+                value = self.clean_rate_value(value)
+                rate = existing.get(currency)
+                if rate is None:
+                    new_rates.append(Rate(source=source, currency=currency, value=value))
+                    changes.created[currency] = value
+                elif self.rate_changed(rate.value, value):
+                    changes.updated[currency] = (rate.value, value)
+                    rate.value = value
+                    changed_rates.append(rate)
+
+            removed_rates = [rate for currency, rate in six.iteritems(existing) if currency not in rates]
+            changes.removed.update((rate.currency, rate.value) for rate in removed_rates)
+
+            Rate.objects.bulk_create(new_rates)
+            self._bulk_update_values(changed_rates)
+            if removed_rates:
+                Rate.objects.filter(pk__in=[rate.pk for rate in removed_rates]).delete()
+
+            if money_rates_settings.RATE_HISTORY_ENABLED:
+                self._record_history(source, existing, new_rates + changed_rates, effective_at)
+
+        rates_updated.send(sender=self.__class__, source=source, changes=changes)
+
+        result = RatesUpdate(created=len(new_rates), updated=len(changed_rates),
+                             unchanged=len(rates) - len(new_rates) - len(changed_rates),
+                             removed=len(removed_rates), changes=changes)
+        logger.debug("Rates for %s updated: %d created, %d updated, %d unchanged, %d removed",
+                     source.name, result.created, result.updated, result.unchanged, result.removed)
+        return result
+
+    def rate_changed(self, old_value, new_value):
+        """
+        Return whether the stored rate 'old_value' must be replaced by 'new_value'
+        """
+        epsilon = money_rates_settings.RATE_CHANGE_EPSILON
+        if not epsilon:
+            return old_value != new_value
+        return abs(new_value - old_value) > abs(old_value) * Decimal(epsilon)
+
+    def save_history(self, dated_rates, batch_size=5000):
+        """
+        Record the `(date, rates)` pairs of 'dated_rates' in the history of
+        the source and return the number of rates recorded.
+
+        'dated_rates' is consumed lazily and written in bulk, 'batch_size'
+        rates at a time. Rates already recorded are skipped, so that the
+        same rates can be loaded again.
+        """
+        source, created = RateSource.objects.get_or_create(
+            name=self.get_source_name(), defaults={'base_currency': self.get_base_currency()})
+
+        count = 0
+        batch = []
+        for date, rates in dated_rates:
+            effective_at = get_effective_at(date)
+            batch.extend((currency, self.clean_rate_value(value), effective_at)
+                         for currency, value in six.iteritems(rates))
+            if len(batch) >= batch_size:
+                count += self._write_history(source, batch)
+                batch = []
+
+        if batch:
+            count += self._write_history(source, batch)
+        return count
+
+    def _write_history(self, source, batch):
+        """
+        Insert the `(currency, value, effective_at)` tuples of 'batch' that
+        are not recorded yet
+        """
+        connection = connections[router.db_for_write(HistoricalRate)]
+        dates = set(effective_at for currency, value, effective_at in batch)
+        recorded = set(HistoricalRate.objects.using(connection.alias).filter(
+            source=source, effective_at__range=(min(dates), max(dates))).values_list('currency', 'effective_at'))
+
+        # Building a model instance for each rate costs more than inserting
+        # it, so rows are prepared with the fields and inserted directly.
+        opts = HistoricalRate._meta
+        fields = [opts.get_field(name) for name in ('source', 'currency', 'value', 'effective_at')]
+        source_field, currency_field, value_field, date_field = fields
+        db_dates = dict((date, date_field.get_db_prep_save(date, connection)) for date in dates)
+        source_id = source_field.get_db_prep_save(source.pk, connection)
+
+        rows = []
+        for currency, value, effective_at in batch:
+            key = (currency, effective_at)
+            if key not in recorded:
+                recorded.add(key)
+                rows.append((source_id, currency, value_field.get_db_prep_save(value, connection),
+                             db_dates[effective_at]))
+
+        if rows:
+            quote_name = connection.ops.quote_name
+            sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+                quote_name(opts.db_table), ", ".join(quote_name(field.column) for field in fields),
+                ", ".join(["%s"] * len(fields)))
+            with connection.cursor() as cursor:
+                cursor.executemany(sql, rows)
+        return len(rows)
+
+    def clean_rate_value(self, value):
+        """
+        Convert a rate value into the Decimal that would be stored in the database
+        """
+        field = Rate._meta.get_field('value')
+        return field.to_python(value).quantize(Decimal(1).scaleb(-field.decimal_places))
+
+    def _record_history(self, source, existing, written_rates, effective_at):
+        """
+        Add the written rates to the history of the source, together with
+        the existing rates that were never recorded.
+        """
+        rates = dict((rate.currency, rate.value) for rate in written_rates)
+
+        # Only the existing rates that were not written may need recording,
+        # the history of the other currencies is not read
+        unwritten = [currency for currency in existing if currency not in rates]
+        if unwritten:
+            recorded = set(HistoricalRate.objects.filter(source=source, currency__in=unwritten)
+                           .values_list('currency', flat=True).distinct())
+            rates.update((currency, existing[currency].value) for currency in unwritten
+                         if currency not in recorded)
+
+        HistoricalRate.objects.bulk_create([
+            HistoricalRate(source=source, currency=currency, value=value, effective_at=effective_at)
+            for currency, value in six.iteritems(rates)
+        ])
+
+    def _bulk_update_values(self, rates):
+        if not rates:
+            return
+
+        # QuerySet.bulk_update is only available since Django 2.2
+        if hasattr(Rate.objects, 'bulk_update'):
+            Rate.objects.bulk_update(rates, ['value'])
+        else:
+            for rate in rates:
+                Rate.objects.filter(pk=rate.pk).update(value=rate.value)
+
+
+def get_effective_at(date):
+    """
+    Return the moment the rates of the day 'date' are effective from, that
+    is its midnight in UTC. Datetimes are returned unchanged.
+    """
+    if isinstance(date, datetime.datetime):
+        return date
+
+    effective_at = datetime.datetime.combine(date, datetime.time())
+    if settings.USE_TZ:
+        effective_at = timezone.make_aware(effective_at, timezone.utc)
+    return effective_at
+
+
+def fetch_rates(backends, deadline=None):
+    """
+    Call `get_rates` of all the 'backends' concurrently and return a list
+    with a `(rates, error)` tuple for each backend.
+
+    Each backend is given `get_timeout()` seconds and no backend is waited
+    for more than 'deadline' seconds. Backends that do not complete in time
+    get a `RateBackendError`.
+    """
+    results = {}
+
+    def fetch(backend):
+        try:
+            results[backend] = (backend.measure_get_rates(), None)
+        except Exception as e:
+            results[backend] = (None, e)
+        finally:
+            # Backends may query the database, e.g. to read the validators of
+            # their source, and the connections of this thread would leak
+            connections.close_all()
+
+    threads = []
+    for backend in backends:
+        # Threads of backends that time out are left behind, they must not
+        # keep the process alive.
+        thread = threading.Thread(target=fetch, args=(backend,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    started_at = time.time()
+    fetched = []
+    for backend, thread in zip(backends, threads):
+        timeout = backend.get_timeout()
+        if deadline is not None:
+            timeout = deadline if timeout is None else min(timeout, deadline)
+
+        thread.join(None if timeout is None else max(timeout - (time.time() - started_at), 0))
+        try:
+            fetched.append(results[backend])
+        except KeyError:
+            fetched.append((None, RateBackendError(
+                "Timeout retrieving rates for %s after %s seconds" % (backend.get_source_name(), timeout))))
 
-            rate.value = value
-            rate.save()
+    return fetched
 
 
 class OpenExchangeBackend(BaseRateBackend):
@@ -89,14 +380,321 @@ class OpenExchangeBackend(BaseRateBackend):
         self.url = base_url
 
     def get_rates(self):
+        """
+        Return the latest rates, or None when they did not change since they
+        were last saved.
+
+        The validators of the saved rates are sent along with the request, so
+        the provider can answer without sending the rates again.
+        """
+        source = RateSource.objects.filter(name=self.get_source_name()).first()
+        headers = {}
+        if source is not None and source.http_etag:
+            headers['If-None-Match'] = source.http_etag
+        if source is not None and source.http_last_modified:
+            headers['If-Modified-Since'] = source.http_last_modified
+
         try:
             logger.debug("Connecting to url %s" % self.url)
-            data = urlopen(self.url).read().decode("utf-8")
-            return json.loads(data)['rates']
+            response = http_request(self.url, headers=headers, timeout=self.get_timeout())
+            if response.status == 304:
+                return None
+            if response.status != 200:
+                raise RateBackendError("Unexpected response status %s" % response.status)
+
+            with metrics.measure('update_rates.parse', source=self.get_source_name()):
+                data = json.loads(response.body.decode("utf-8"))
+                rates = data['rates']
 
         except Exception as e:
             logger.exception("Error retrieving data from %s", self.url)
             raise RateBackendError("Error retrieving rates: %s" % e)
 
+        timestamp = data.get('timestamp')
+        if timestamp is not None:
+            timestamp = datetime.datetime.fromtimestamp(timestamp, timezone.utc)
+            if not settings.USE_TZ:
+                timestamp = timezone.make_naive(timestamp)
+            if source is not None and source.rates_timestamp == timestamp:
+                return None
+
+        self.validators = {
+            'http_etag': response.headers.get('etag', ''),
+            'http_last_modified': response.headers.get('last-modified', ''),
+            'rates_timestamp': timestamp,
+        }
+        return rates
+
+    def get_historical_rates(self, start, end):
+        """
+        Request the rates of each day from the historical endpoint
+        """
+        date = start
+        while date <= end:
+            url = "%s%s.json?app_id=%s&base=%s" % (
+                money_rates_settings.OPENEXCHANGE_HISTORICAL_URL, date.isoformat(),
+                money_rates_settings.OPENEXCHANGE_APP_ID, self.get_base_currency())
+            try:
+                response = http_request(url, timeout=self.get_timeout())
+                if response.status != 200:
+                    raise RateBackendError("Unexpected response status %s" % response.status)
+                rates = json.loads(response.body.decode("utf-8"))['rates']
+            except Exception as e:
+                logger.exception("Error retrieving data from %s", url)
+                raise RateBackendError("Error retrieving rates of %s: %s" % (date, e))
+
+            yield date, rates
+            date += datetime.timedelta(days=1)
+
     def get_base_currency(self):
         return money_rates_settings.OPENEXCHANGE_BASE_CURRENCY
+
+
+# Files larger than this are memory mapped instead of read through a buffer
+MMAP_THRESHOLD = 1024 * 1024
+
+
+@contextlib.contextmanager
+def open_rates_file(path):
+    """
+    Open the file 'path' for binary reading, decompressing it when its name
+    ends with `.gz`. Large files are memory mapped.
+    """
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:
+            yield f
+        return
+
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < MMAP_THRESHOLD:
+            yield f
+            return
+
+        with contextlib.closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as mapped:
+            yield mapped
+
+
+def parse_date(value):
+    """
+    Parse an ISO 8601 date, or a Unix timestamp, into a date. Dates are
+    returned unchanged.
+    """
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    if isinstance(value, six.integer_types + (float,)):
+        return datetime.datetime.utcfromtimestamp(value).date()
+    return datetime.datetime.strptime(value[:10], '%Y-%m-%d').date()
+
+
+class FileRateBackend(BaseRateBackend):
+    """
+    Base class of the backends that read rates from local files.
+
+    'path' is a file, or a directory whose files are read in the order of
+    their names (e.g. a daily file named after its date). Subclasses
+    implement `parse` and set `source_name` and `base_currency`.
+    """
+    path = None
+    # Extensions of the files read from a directory
+    extensions = ()
+
+    def __init__(self, path=None):
+        if path is not None:
+            self.path = path
+        if not self.path:
+            raise ImproperlyConfigured("'path' should not be empty when using %s" % self.__class__.__name__)
+
+    def get_paths(self):
+        """
+        Return the files to read, oldest first
+        """
+        if not os.path.isdir(self.path):
+            return [self.path]
+
+        paths = []
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith('.gz'):
+                extension = os.path.splitext(name[:-3])[1]
+            else:
+                extension = os.path.splitext(name)[1]
+            if extension.lower() in self.extensions:
+                paths.append(os.path.join(self.path, name))
+        return paths
+
+    def parse(self, f):
+        """
+        Yield the `(date, rates)` pairs found in the binary file 'f'. The
+        date is None when the file does not say it.
+        """
+        raise NotImplementedError
+
+    def iter_rates(self):
+        """
+        Yield the `(date, rates)` pairs of all the files, reading them
+        incrementally
+        """
+        for path in self.get_paths():
+            with open_rates_file(path) as f:
+                for date, rates in self.parse(f):
+                    yield date, rates
+
+    def get_historical_rates(self, start, end):
+        """
+        Yield the rates of the days from 'start' to 'end' found in the files.
+        Files named after a date out of the range are not read.
+        """
+        for path in self.get_paths():
+            file_date = self._get_file_date(path)
+            if file_date is not None and not start <= file_date <= end:
+                continue
+
+            with open_rates_file(path) as f:
+                for date, rates in self.parse(f):
+                    if date is not None and start <= date <= end:
+                        yield date, rates
+
+    def is_history_streamed(self):
+        """
+        The history is streamed unless every file is named after its date
+        """
+        return any(self._get_file_date(path) is None for path in self.get_paths())
+
+    def _get_file_date(self, path):
+        try:
+            return parse_date(os.path.basename(path))
+        except ValueError:
+            return None
+
+    def get_rates(self):
+        """
+        Return the rates of the most recent date of the last file, or None
+        when they were already saved.
+        """
+        paths = self.get_paths()
+        if not paths:
+            raise RateBackendError("No rates file found in %s" % self.path)
+
+        latest_date, latest_rates = None, None
+        with open_rates_file(paths[-1]) as f:
+            with metrics.measure('update_rates.parse', source=self.get_source_name()):
+                for date, rates in self.parse(f):
+                    # Dated rates are preferred to the ones without a date
+                    if latest_rates is None or (date is not None and (latest_date is None or date > latest_date)):
+                        latest_date, latest_rates = date, rates
+
+        if latest_rates is None:
+            raise RateBackendError("No rates found in %s" % paths[-1])
+
+        timestamp = get_effective_at(latest_date) if latest_date is not None else None
+        if timestamp is not None:
+            source = RateSource.objects.filter(name=self.get_source_name()).first()
+            if source is not None and source.rates_timestamp == timestamp:
+                return None
+
+        self.validators = {'rates_timestamp': timestamp}
+        return latest_rates
+
+
+class JSONFileBackend(FileRateBackend):
+    """
+    Reads rates from JSON documents shaped as the responses of Open Exchange
+    Rates (`{"timestamp": ..., "rates": {...}}`), or from JSON lines files
+    (`.jsonl`) with one such document per line, e.g. one per day. A `date`
+    member can be given instead of the `timestamp`.
+
+    JSON lines files are parsed one line at a time.
+    """
+    extensions = ('.json', '.jsonl')
+
+    def parse(self, f):
+        line = f.readline()
+        try:
+            document = json.loads(line.decode('utf-8'))
+        except ValueError:
+            # A single document spanning several lines
+            f.seek(0)
+            yield self._parse_document(json.loads(f.read().decode('utf-8')))
+            return
+
+        yield self._parse_document(document)
+        for line in iter(f.readline, b''):
+            line = line.strip()
+            if line:
+                yield self._parse_document(json.loads(line.decode('utf-8')))
+
+    def _parse_document(self, data):
+        date = data.get('date', data.get('timestamp'))
+        return (parse_date(date) if date is not None else None), data['rates']
+
+
+class CSVFileBackend(FileRateBackend):
+    """
+    Reads rates from CSV files with a header row, either with a row per day
+    and a column per currency (`Date,USD,JPY,...` as published by the ECB),
+    or with a row per rate (`date,currency,rate`).
+
+    Rows of a day per row are parsed one at a time, while the rows of a rate
+    per row are read whole, since the rates of a date may be spread across
+    the file. Blank rows and empty or `N/A` values are skipped in both
+    layouts.
+    """
+    extensions = ('.csv',)
+
+    def parse(self, f):
+        reader = csv.reader(self._iter_lines(f))
+        header = [name.strip() for name in next(reader, [])]
+
+        if [name.lower() for name in header] == ['date', 'currency', 'rate']:
+            # The rows of a date are not necessarily consecutive, e.g. in a
+            # file sorted by currency, so the rates of every date are collected
+            dated_rates = OrderedDict()
+            for row in reader:
+                if len(row) < 3 or not row[0].strip():
+                    continue
+                rates = dated_rates.setdefault(row[0].strip(), {})
+                if row[1].strip() and self._is_value(row[2]):
+                    rates[row[1].strip()] = row[2].strip()
+            for date, rates in dated_rates.items():
+                yield parse_date(date), rates
+            return
+
+        currencies = header[1:]
+        for row in reader:
+            if not row or not row[0].strip():
+                continue
+            rates = dict((currency, value.strip()) for currency, value in zip(currencies, row[1:])
+                         if currency and self._is_value(value))
+            yield parse_date(row[0].strip()), rates
+
+    def _is_value(self, value):
+        value = value.strip()
+        return bool(value) and value != 'N/A'
+
+    def _iter_lines(self, f):
+        for line in iter(f.readline, b''):
+            # The csv module of Python 2 works on byte strings
+            yield line if six.PY2 else line.decode('utf-8')
+
+
+class ECBXMLFileBackend(FileRateBackend):
+    """
+    Reads the euro foreign exchange reference rates of the European Central
+    Bank from the XML files it publishes (`eurofxref-daily.xml`,
+    `eurofxref-hist.xml`), parsing them incrementally.
+    """
+    source_name = "ecb"
+    base_currency = "EUR"
+    extensions = ('.xml',)
+
+    def parse(self, f):
+        for event, element in ElementTree.iterparse(f):
+            if not element.tag.endswith('Cube') or 'time' not in element.attrib:
+                continue
+
+            rates = dict((cube.get('currency'), cube.get('rate')) for cube in element if cube.get('currency'))
+            rates[self.get_base_currency()] = 1
+            yield parse_date(element.get('time')), rates
+            # Days are dropped once parsed, so that memory does not grow with the file
+            element.clear()
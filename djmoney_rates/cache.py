@@ -0,0 +1,491 @@
+from __future__ import unicode_literals
+
+"""
+In-process cache of the rates stored for each `RateSource`.
+
+The rates of a source are loaded with a single query into a `RateTable`.
+A cached table is considered valid as long as the `RateSource` row it was
+loaded from is unchanged, so that refreshes performed by other processes
+(e.g. a cron running `update_rates`) are picked up. The version check is
+performed at most once every `RATE_CACHE_CHECK_INTERVAL` seconds, while
+changes made in the current process invalidate the cache immediately.
+
+When `SHARED_CACHE_ALIAS` is set, the tables are also published to that
+Django cache and processes read them from there before falling back to
+the database.
+
+When several sources are configured their tables are merged into a single
+index, rebuilt only when one of the tables is reloaded.
+
+Stale rates are refreshed in the background when `RATE_REFRESH_ENABLED`
+is set, see `djmoney_rates.refresh`.
+"""
+
+import hashlib
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from decimal import localcontext
+
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import metrics
+from .exceptions import CurrencyConversionException
+from .models import Rate, RateSource
+from .refresh import rate_refresher
+from .settings import money_rates_settings
+from .signals import rates_updated
+from .tables import ONE, RATE_SCALE, BaseRates, RateTable, scale_rate
+
+
+logger = logging.getLogger(__name__)
+
+
+class CachedRates(BaseRates):
+    """
+    A `RateTable` held by the cache, with an index of its rates by currency
+    code and the cross rates computed so far.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.source_name = table.source_name
+        self.source_id = table.source_id
+        self.base_currency = table.base_currency
+        self.version = table.version
+        self.rates = dict(table.items())
+        self.checked_at = time.time()
+        # Tick of the last lookup, used to evict the least recently used sources
+        self.used_at = 0
+        self._scaled_rates = None
+        self._cross_rates = OrderedDict()
+        self._cross_rates_lock = threading.Lock()
+
+    def get_rate(self, currency):
+        try:
+            return self.rates[currency]
+        except KeyError:
+            raise CurrencyConversionException(
+                "Rate for %s in %s do not exists. "
+                "Please run python manage.py update_rates" % (
+                    currency, self.source_name))
+
+    def get_scaled_pair_rates(self, currency_from, currency_to):
+        scaled_rates = self._scaled_rates
+        if scaled_rates is None:
+            # Built on first use, only by the callers of the integer path
+            scaled_rates = self._scaled_rates = dict(
+                (currency, scale_rate(value)) for currency, value in self.rates.items())
+
+        try:
+            scaled_from = RATE_SCALE if currency_from == self.base_currency else scaled_rates[currency_from]
+            return scaled_from, scaled_rates[currency_to]
+        except KeyError:
+            # Let the base class raise the missing rate error
+            return super(CachedRates, self).get_scaled_pair_rates(currency_from, currency_to)
+
+    def get_cross_rate(self, currency_from, currency_to):
+        """
+        Return the rate that converts 'currency_from' into 'currency_to'.
+
+        Cross rates are computed on first use and the most recently used
+        `CROSS_RATES_MAX_PAIRS` of them are kept.
+        """
+        pair = (currency_from, currency_to)
+        with self._cross_rates_lock:
+            try:
+                cross_rate = self._cross_rates.pop(pair)
+            except KeyError:
+                cross_rate = None
+            else:
+                # Move the pair to the most recently used end
+                self._cross_rates[pair] = cross_rate
+                return cross_rate
+
+        rate_from, rate_to = self.get_pair_rates(currency_from, currency_to)
+        # Extra precision keeps the single multiplication as accurate as the
+        # division followed by the multiplication it replaces.
+        with localcontext() as context:
+            context.prec = 50
+            cross_rate = rate_to / rate_from
+
+        with self._cross_rates_lock:
+            self._cross_rates[pair] = cross_rate
+            while len(self._cross_rates) > money_rates_settings.CROSS_RATES_MAX_PAIRS:
+                self._cross_rates.popitem(last=False)
+
+        return cross_rate
+
+
+def merge_rates(tables):
+    """
+    Return a `CachedRates` with the rates of each currency found in the first
+    of the `CachedRates` 'tables' providing it, expressed in the base
+    currency of the first table.
+
+    Tables that can't be related to the first one, since they have no rate
+    in common with it, are ignored.
+    """
+    primary = tables[0]
+    base_currency = primary.base_currency
+    rates = dict(primary.rates)
+
+    for table in tables[1:]:
+        # Rate of the base currency of 'table' in the base currency of 'primary'
+        if table.base_currency == base_currency:
+            factor = ONE
+        elif base_currency in table.rates:
+            factor = ONE / table.rates[base_currency]
+        elif table.base_currency in rates:
+            factor = rates[table.base_currency]
+        else:
+            logger.warning("Rates of %s source cannot be merged with the rates of %s source",
+                           table.source_name, primary.source_name)
+            continue
+
+        for currency, value in table.rates.items():
+            if currency not in rates:
+                rates[currency] = value * factor
+        if table.base_currency not in rates:
+            rates[table.base_currency] = factor
+
+    version = tuple(table.version for table in tables)
+    return CachedRates(RateTable(primary.source_name, primary.source_id, base_currency, version, rates))
+
+
+class SharedRateCache(object):
+    """
+    Publishes snapshots of the rate tables to a Django cache, so that
+    processes can share them instead of loading the rates from the database.
+
+    For each source the cache holds a pointer to the current version and
+    a snapshot of the rates keyed by source and version.
+    """
+
+    def get_cache(self):
+        alias = money_rates_settings.SHARED_CACHE_ALIAS
+        return caches[alias] if alias else None
+
+    def get_version(self, source_name):
+        return self.get_cache().get(self._make_key('version', source_name))
+
+    def get(self, source_name, version):
+        table = self.get_cache().get(self._make_key('rates', source_name, version))
+        if table is None:
+            return None
+        return CachedRates(table)
+
+    def publish(self, table, replace=True):
+        """
+        Store the `RateTable` 'table' and make it the current version of its
+        source. Unless 'replace' is True the current version is changed
+        only when missing, so that a stale table can't replace a fresh one.
+        """
+        cache = self.get_cache()
+        timeout = money_rates_settings.SHARED_CACHE_TIMEOUT
+        cache.set(self._make_key('rates', table.source_name, table.version), table, timeout)
+
+        version_key = self._make_key('version', table.source_name)
+        if replace:
+            cache.set(version_key, table.version, timeout)
+        else:
+            cache.add(version_key, table.version, timeout)
+
+    def invalidate(self, source_name):
+        self.get_cache().delete(self._make_key('version', source_name))
+
+    def _make_key(self, kind, source_name, version=None):
+        # Source names are hashed since they may contain characters that
+        # are not valid in some cache backends keys.
+        digest = hashlib.md5(repr((source_name, version)).encode('utf-8')).hexdigest()
+        return 'djmoney_rates:%s:%s' % (kind, digest)
+
+
+class RateCache(object):
+    """
+    Holds a `CachedRates` instance for each source name, for at most
+    `RATE_CACHE_MAX_SOURCES` sources: the least recently used are evicted.
+    """
+
+    def __init__(self):
+        self._tables = {}
+        self._ticks = itertools.count(1)
+        # Merged tables keyed by the names of their sources, with the tables
+        # they were built from
+        self._merged = {}
+        self._lock = threading.RLock()
+        self.shared = SharedRateCache()
+
+    def get(self, source_name):
+        """
+        Return the `CachedRates` of `source_name`, loading them if needed.
+
+        Inside a `rates_snapshot` block the rates returned for a source are
+        always the ones returned the first time.
+        """
+        pinned = _pinned_tables.get()
+        if pinned is None:
+            return self._get(source_name)
+
+        try:
+            return pinned[source_name]
+        except KeyError:
+            table = pinned[source_name] = self._get(source_name)
+            return table
+
+    def peek(self, source_name):
+        """
+        Return the `CachedRates` of `source_name` only if they can be
+        returned without any I/O, None otherwise.
+        """
+        pinned = _pinned_tables.get()
+        if pinned is not None and source_name in pinned:
+            return pinned[source_name]
+
+        if not money_rates_settings.RATE_CACHE_ENABLED:
+            return None
+
+        table = self._tables.get(source_name)
+        if table is None or not self._is_fresh(table):
+            return None
+
+        table.used_at = next(self._ticks)
+        if metrics.is_enabled():
+            metrics.emit('rate_cache.hit', source=source_name)
+        if pinned is not None:
+            pinned[source_name] = table
+        return table
+
+    def get_merged(self, source_names):
+        """
+        Return the `CachedRates` merging the rates of 'source_names', in
+        order of priority. See `merge_rates`.
+        """
+        return self._merge(source_names, [self.get(source_name) for source_name in source_names])
+
+    def peek_merged(self, source_names):
+        """
+        Return the merged `CachedRates` of 'source_names' only if they can be
+        returned without any I/O, None otherwise.
+        """
+        tables = []
+        for source_name in source_names:
+            table = self.peek(source_name)
+            if table is None:
+                return None
+            tables.append(table)
+        return self._merge(source_names, tables)
+
+    def _merge(self, source_names, tables):
+        key = tuple(source_names)
+        try:
+            merged_from, merged = self._merged[key]
+        except KeyError:
+            pass
+        else:
+            if all(old is new for old, new in zip(merged_from, tables)):
+                return merged
+
+        merged = merge_rates(tables)
+        self._merged[key] = (tables, merged)
+        return merged
+
+    def _get(self, source_name):
+        if not money_rates_settings.RATE_CACHE_ENABLED:
+            return self._fetch(source_name, None)
+
+        table = self._tables.get(source_name)
+        if table is not None and self._is_fresh(table):
+            table.used_at = next(self._ticks)
+            if metrics.is_enabled():
+                metrics.emit('rate_cache.hit', source=source_name)
+            return table
+
+        with self._lock:
+            current = self._tables.get(source_name)
+            if current is not table and current is not None:
+                # Reloaded by another thread in the meantime
+                return current
+
+            fetched = self._fetch(source_name, table)
+            fetched.used_at = next(self._ticks)
+            self._tables[source_name] = fetched
+            self._evict()
+
+        if metrics.is_enabled():
+            metrics.emit('rate_cache.hit' if fetched is table else 'rate_cache.miss', source=source_name)
+        return fetched
+
+    def invalidate(self, source_name=None, source_id=None):
+        """
+        Drop the cached rates of a source, or of every source if no argument
+        is given.
+        """
+        with self._lock:
+            if source_name is None and source_id is None:
+                self._tables.clear()
+                self._merged.clear()
+                return
+
+            for name, table in list(self._tables.items()):
+                if name == source_name or table.source_id == source_id:
+                    del self._tables[name]
+
+    def _evict(self):
+        # Recency is tracked without locking the lookups, so the least
+        # recently used source is searched for only when one must go.
+        max_sources = money_rates_settings.RATE_CACHE_MAX_SOURCES
+        while max_sources and len(self._tables) > max_sources:
+            source_name = min(self._tables, key=lambda name: self._tables[name].used_at)
+            del self._tables[source_name]
+            for key in [key for key in self._merged if source_name in key]:
+                del self._merged[key]
+
+    def _is_fresh(self, table):
+        interval = money_rates_settings.RATE_CACHE_CHECK_INTERVAL
+        return bool(interval) and time.time() - table.checked_at < interval
+
+    def _fetch(self, source_name, table):
+        """
+        Return the current rates of 'source_name', which is 'table' itself
+        when its version is still the current one, and schedule their
+        refresh when they are stale.
+        """
+        fetched = self._fetch_table(source_name, table)
+        if money_rates_settings.RATE_REFRESH_ENABLED:
+            rate_refresher.check(fetched)
+        return fetched
+
+    def _fetch_table(self, source_name, table):
+        if money_rates_settings.SHARED_CACHE_ALIAS:
+            try:
+                version = self.shared.get_version(source_name)
+                if version is not None:
+                    if table is not None and table.version == version:
+                        table.checked_at = time.time()
+                        return table
+
+                    shared_table = self.shared.get(source_name, version)
+                    if shared_table is not None:
+                        return shared_table
+            except Exception:
+                if not money_rates_settings.SHARED_CACHE_FALLBACK:
+                    raise
+                logger.warning("Cannot read %s rates from the shared cache", source_name, exc_info=True)
+
+            if not money_rates_settings.SHARED_CACHE_FALLBACK:
+                raise CurrencyConversionException(
+                    "Rates for %s source are not available in the shared cache. "
+                    "Please run python manage.py update_rates" % source_name)
+
+        version = self._get_version(source_name)
+        if table is not None and table.version == version:
+            table.checked_at = time.time()
+            return table
+
+        table = self._load(source_name, version)
+        if money_rates_settings.SHARED_CACHE_ALIAS:
+            self.shared.publish(table.table, replace=False)
+        return table
+
+    def _get_version(self, source_name):
+        try:
+            return RateSource.objects.values_list(
+                'pk', 'base_currency', 'last_update').get(name=source_name)
+        except RateSource.DoesNotExist:
+            self.invalidate(source_name)
+            raise CurrencyConversionException(
+                "Rate for %s source do not exists. "
+                "Please run python manage.py update_rates" % source_name)
+
+    def _load(self, source_name, version):
+        source_id, base_currency = version[0], version[1]
+        source = RateSource(pk=source_id, name=source_name, base_currency=base_currency)
+        return CachedRates(RateTable.from_source(source, version))
+
+
+rate_cache = RateCache()
+
+
+class _LocalVar(object):
+    """
+    Replacement of `contextvars.ContextVar` based on thread locals, used on
+    Python versions without contextvars.
+    """
+
+    def __init__(self, name, default=None):
+        self.name = name
+        self._default = default
+        self._local = threading.local()
+
+    def get(self):
+        return getattr(self._local, 'value', self._default)
+
+    def set(self, value):
+        token = self.get()
+        self._local.value = value
+        return token
+
+    def reset(self, token):
+        self._local.value = token
+
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = _LocalVar
+
+# Tables pinned by the current rates_snapshot block, keyed by source name
+_pinned_tables = ContextVar('djmoney_rates_pinned_tables', default=None)
+
+
+class rates_snapshot(object):
+    """
+    Context manager that pins the rates of each source the first time they
+    are used in its block, so that all the conversions of the block use the
+    same rates and do not query the database again.
+
+    The snapshot is local to the current thread or asyncio task; nested
+    blocks share the snapshot of the outermost one.
+    """
+
+    def __enter__(self):
+        pinned = _pinned_tables.get()
+        self._token = _pinned_tables.set(pinned if pinned is not None else {})
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _pinned_tables.reset(self._token)
+
+
+@receiver(rates_updated, dispatch_uid='djmoney_rates_cache_rates_updated')
+def _invalidate_on_update(sender, source, **kwargs):
+    rate_cache.invalidate(source.name)
+
+    if money_rates_settings.SHARED_CACHE_ALIAS:
+        version = rate_cache._get_version(source.name)
+        rate_cache.shared.publish(rate_cache._load(source.name, version).table)
+
+
+@receiver(post_save, sender=RateSource, dispatch_uid='djmoney_rates_cache_source_saved')
+@receiver(post_delete, sender=RateSource, dispatch_uid='djmoney_rates_cache_source_deleted')
+def _invalidate_on_source_change(sender, instance, **kwargs):
+    rate_cache.invalidate(instance.name, instance.pk)
+
+    if money_rates_settings.SHARED_CACHE_ALIAS:
+        rate_cache.shared.invalidate(instance.name)
+
+
+@receiver(post_save, sender=Rate, dispatch_uid='djmoney_rates_cache_rate_saved')
+@receiver(post_delete, sender=Rate, dispatch_uid='djmoney_rates_cache_rate_deleted')
+def _invalidate_on_rate_change(sender, instance, **kwargs):
+    rate_cache.invalidate(source_id=instance.source_id)
+
+    if money_rates_settings.SHARED_CACHE_ALIAS:
+        source_name = RateSource.objects.filter(pk=instance.source_id).values_list('name', flat=True).first()
+        if source_name is not None:
+            rate_cache.shared.invalidate(source_name)
@@ -0,0 +1,97 @@
+from __future__ import unicode_literals
+
+"""
+Query expressions converting amounts in the database.
+
+They require Django 1.11 or later, since they rely on subqueries.
+"""
+
+import threading
+
+from django.db.models import Case, DecimalField, F, Func, OuterRef, Subquery, Value, When
+
+from .exceptions import CurrencyConversionException
+from .models import Rate
+from .tables import ONE, get_decimal_places
+
+
+# Set while the currencies of a query are checked
+_checking = threading.local()
+
+
+class ConvertedAmount(Func):
+    """
+    The amount of the field 'amount', in the currency of the field
+    'currency', converted to the currency 'to' with the rates of the default
+    Rate Source and rounded to the decimal places of 'to'::
+
+        Invoice.objects.aggregate(total=Sum(ConvertedAmount('amount', 'currency', to='EUR')))
+
+    The rounding is performed by the database `ROUND` function, that may
+    round ties away from zero whatever the `ROUNDING` setting. Only the rates
+    of the first of the `RATE_SOURCES` are read from the database.
+
+    Rows whose currency has no rate would be converted to NULL, and left out
+    of aggregations, so when the query is evaluated the currencies of its rows
+    are checked with an additional query raising `CurrencyConversionException`
+    when some rates are missing. The check is skipped when 'check_currencies'
+    is False.
+    """
+    function = 'ROUND'
+
+    def __init__(self, amount, currency, to, rates=None, output_field=None, check_currencies=True):
+        if rates is None:
+            from .utils import get_cached_rates
+            rates = get_cached_rates()
+
+        rate_to = rates.get_rate(to)
+        rate_from = Case(
+            # If currency from is the same as base currency its rate is 1.
+            When(**{currency: rates.base_currency, 'then': Value(ONE)}),
+            default=Subquery(
+                Rate.objects.filter(source_id=rates.source_id, currency=OuterRef(currency)).values('value')[:1]),
+            output_field=DecimalField(max_digits=20, decimal_places=6),
+        )
+
+        decimal_places = get_decimal_places(to)
+        if output_field is None:
+            output_field = DecimalField(max_digits=30, decimal_places=decimal_places)
+
+        converted = F(amount) / rate_from * Value(rate_to)
+        super(ConvertedAmount, self).__init__(converted, Value(decimal_places), output_field=output_field)
+
+        self.currency = currency
+        self.rates = rates
+        self.check_currencies = check_currencies
+
+    def as_sql(self, compiler, connection, *args, **kwargs):
+        # The check compiles a query of its own, that may contain this expression
+        if self.check_currencies and not getattr(_checking, 'active', False):
+            _checking.active = True
+            try:
+                self._check_currencies(compiler.query, compiler.using)
+            finally:
+                _checking.active = False
+        return super(ConvertedAmount, self).as_sql(compiler, connection, *args, **kwargs)
+
+    def _check_currencies(self, query, using):
+        """
+        Raise `CurrencyConversionException` if some rows of 'query' are in a
+        currency without a rate
+        """
+        check_query = query.chain() if hasattr(query, 'chain') else query.clone()
+        check_query.clear_limits()
+        check_query.clear_ordering(True)
+        queryset = query.model._base_manager.using(using).all()
+        queryset.query = check_query
+
+        missing = (queryset
+                   .exclude(**{self.currency + '__isnull': True})
+                   .exclude(**{self.currency: self.rates.base_currency})
+                   .exclude(**{self.currency + '__in': Rate.objects.filter(
+                       source_id=self.rates.source_id).values('currency')})
+                   .values_list(self.currency, flat=True).distinct())
+        missing = sorted(missing[:10])
+        if missing:
+            raise CurrencyConversionException(
+                "Rate for %s in %s do not exists" % (", ".join(missing), self.rates.source_name))
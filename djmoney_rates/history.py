@@ -0,0 +1,154 @@
+from __future__ import unicode_literals
+
+"""
+Point-in-time lookup of the rates recorded in `HistoricalRate`.
+
+`RatesAt` looks up the rates valid at a given moment with an indexed
+`LIMIT 1` lookup per currency, run in a single query, while `RateHistory`
+preloads the rates of a whole period so that many dated conversions cost a
+handful of queries.
+"""
+
+import bisect
+from collections import OrderedDict, defaultdict
+
+from django.db.models import Max
+
+try:
+    from django.db.models import Subquery
+except ImportError:
+    # Django < 1.11 reads the rates of a pair with a query per currency
+    Subquery = None
+
+from .exceptions import CurrencyConversionException
+from .models import HistoricalRate, RateSource
+from .tables import ONE, BaseRates
+
+
+def _missing_rate(currency, source_name, at):
+    return CurrencyConversionException(
+        "Rate for %s in %s at %s do not exists. "
+        "Please run python manage.py update_rates" % (currency, source_name, at))
+
+
+class RatesAt(BaseRates):
+    """
+    The rates of a source valid at the moment 'at'.
+    """
+
+    def __init__(self, source_name, source_id, base_currency, at):
+        self.source_name = source_name
+        self.source_id = source_id
+        self.base_currency = base_currency
+        self.at = at
+
+    def get_rate(self, currency):
+        value = self._get_latest(currency).values_list('value', flat=True).first()
+
+        if value is None:
+            raise _missing_rate(currency, self.source_name, self.at)
+        return value
+
+    def get_pair_rates(self, currency_from, currency_to):
+        """
+        Return the rates of 'currency_from' and 'currency_to', read with a
+        single query of an indexed `LIMIT 1` subquery per currency
+        """
+        if Subquery is None:
+            return super(RatesAt, self).get_pair_rates(currency_from, currency_to)
+
+        currencies = [currency_from, currency_to] if currency_from != self.base_currency else [currency_to]
+        lookups = OrderedDict(('rate_%d' % index, Subquery(self._get_latest(currency).values('value')[:1]))
+                              for index, currency in enumerate(currencies))
+        row = RateSource.objects.filter(pk=self.source_id).annotate(**lookups).values_list(*lookups).first()
+
+        rates = []
+        for index, currency in enumerate(currencies):
+            if row is None or row[index] is None:
+                raise _missing_rate(currency, self.source_name, self.at)
+            rates.append(row[index])
+        return (ONE, rates[0]) if len(rates) == 1 else tuple(rates)
+
+    def _get_latest(self, currency):
+        """
+        Return the history of 'currency' up to the moment 'at', latest first
+        """
+        return HistoricalRate.objects.filter(
+            source_id=self.source_id, currency=currency, effective_at__lte=self.at,
+        ).order_by('-effective_at')
+
+
+class RateHistory(object):
+    """
+    The rates of a source between 'start' and 'end', loaded at once.
+    """
+
+    def __init__(self, source_name, source_id, base_currency, start, end, currencies=None):
+        self.source_name = source_name
+        self.source_id = source_id
+        self.base_currency = base_currency
+        self.start = start
+        self.end = end
+        self._timelines = self._load(currencies)
+
+    def at(self, at):
+        """
+        Return the rates valid at the moment 'at'
+        """
+        if not self.start <= at <= self.end:
+            raise ValueError("%s is outside of the loaded history from %s to %s" % (at, self.start, self.end))
+        return RateHistoryView(self, at)
+
+    def get_rate(self, currency, at):
+        try:
+            dates, values = self._timelines[currency]
+        except KeyError:
+            raise _missing_rate(currency, self.source_name, at)
+
+        index = bisect.bisect_right(dates, at)
+        if not index:
+            raise _missing_rate(currency, self.source_name, at)
+        return values[index - 1]
+
+    def _load(self, currencies):
+        history = HistoricalRate.objects.filter(source_id=self.source_id)
+        if currencies is not None:
+            history = history.filter(currency__in=currencies)
+
+        # Rates already valid when the period starts
+        latest = dict(
+            history.filter(effective_at__lte=self.start)
+            .values('currency').annotate(latest=Max('effective_at'))
+            .values_list('currency', 'latest'))
+        rows = [
+            row for row in history.filter(effective_at__in=set(latest.values()))
+            .values_list('currency', 'effective_at', 'value')
+            if latest.get(row[0]) == row[1]
+        ]
+
+        # Rates changed during the period
+        rows.extend(
+            history.filter(effective_at__gt=self.start, effective_at__lte=self.end)
+            .values_list('currency', 'effective_at', 'value'))
+
+        timelines = defaultdict(lambda: ([], []))
+        for currency, effective_at, value in sorted(rows):
+            dates, values = timelines[currency]
+            dates.append(effective_at)
+            values.append(value)
+        return dict(timelines)
+
+
+class RateHistoryView(BaseRates):
+    """
+    The rates of a `RateHistory` valid at the moment 'at'.
+    """
+
+    def __init__(self, history, at):
+        self.history = history
+        self.source_name = history.source_name
+        self.base_currency = history.base_currency
+        self.at = at
+
+    def get_rate(self, currency):
+        return self.history.get_rate(currency, self.at)
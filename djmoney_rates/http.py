@@ -0,0 +1,122 @@
+from __future__ import unicode_literals
+
+"""
+Minimal HTTP client used by the rate backends.
+
+Connections are kept alive and reused across requests to the same host,
+so that backends refreshed periodically by a long running process do not
+pay a new connection (and TLS handshake) on every refresh.
+"""
+
+import socket
+import threading
+from collections import namedtuple
+
+from django.utils.six.moves import http_client
+from django.utils.six.moves.urllib.parse import urljoin, urlsplit
+
+
+HTTPResponse = namedtuple('HTTPResponse', ['status', 'headers', 'body'])
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
+
+class ConnectionPool(object):
+    """
+    Keeps up to 'maxsize' idle connections for each host.
+    """
+
+    def __init__(self, maxsize=4):
+        self.maxsize = maxsize
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def request(self, url, headers=None, timeout=None):
+        """
+        Perform a GET request following redirects and return an `HTTPResponse`
+        whose headers have lower case names.
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self._request(url, headers or {}, timeout)
+            if response.status not in REDIRECT_STATUSES or 'location' not in response.headers:
+                return response
+            url = urljoin(url, response.headers['location'])
+
+        raise http_client.HTTPException("Too many redirects for %s" % url)
+
+    def clear(self):
+        """
+        Close all the idle connections
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _request(self, url, headers, timeout):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+
+        connection, reused = self._acquire(key, timeout)
+        try:
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+            body = response.read()
+        except (http_client.HTTPException, socket.error):
+            connection.close()
+            if not reused:
+                raise
+            # The server may have closed an idle connection, retry on a new one
+            connection, reused = self._acquire(key, timeout, fresh=True)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except Exception:
+                connection.close()
+                raise
+
+        response_headers = dict((name.lower(), value) for name, value in response.getheaders())
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(key, connection)
+
+        return HTTPResponse(response.status, response_headers, body)
+
+    def _acquire(self, key, timeout, fresh=False):
+        if not fresh:
+            with self._lock:
+                connections = self._idle.get(key)
+                connection = connections.pop() if connections else None
+
+            if connection is not None:
+                connection.timeout = timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+                return connection, True
+
+        scheme, netloc = key
+        connection_class = http_client.HTTPSConnection if scheme == 'https' else http_client.HTTPConnection
+        return connection_class(netloc, timeout=timeout), False
+
+    def _release(self, key, connection):
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.maxsize:
+                connections.append(connection)
+                return
+        connection.close()
+
+
+connection_pool = ConnectionPool()
+
+
+def http_request(url, headers=None, timeout=None):
+    """
+    Perform a GET request on 'url' reusing the pooled connections
+    """
+    return connection_pool.request(url, headers, timeout)
@@ -0,0 +1,229 @@
+from __future__ import unicode_literals
+
+import collections
+import datetime
+import io
+import json
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from ... import metrics
+from ...backends import FileRateBackend, parse_date
+from ...settings import money_rates_settings, import_from_string
+
+
+ONE_DAY = datetime.timedelta(days=1)
+
+
+def split_range(start, end, days):
+    """
+    Return the `(start, end)` pairs of the chunks of at most 'days' days
+    covering the range from 'start' to 'end', both included
+    """
+    chunks = []
+    while start <= end:
+        chunk_end = min(start + datetime.timedelta(days=days - 1), end)
+        chunks.append((start, chunk_end))
+        start = chunk_end + ONE_DAY
+    return chunks
+
+
+def merge_ranges(ranges):
+    """
+    Return the `(start, end)` date ranges of 'ranges' merged when they
+    overlap or touch, sorted
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + ONE_DAY:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def is_backfilled(ranges, date):
+    return any(start <= date <= end for start, end in ranges)
+
+
+def read_checkpoint(path, source_name):
+    """
+    Return the date ranges already backfilled according to the checkpoint
+    file 'path', empty when the file does not exist
+    """
+    if not os.path.exists(path):
+        return []
+
+    with io.open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    if data.get('source') != source_name:
+        raise CommandError("Checkpoint %s belongs to %s" % (path, data.get('source')))
+    return [(parse_date(start), parse_date(end)) for start, end in data['backfilled']]
+
+
+def write_checkpoint(path, source_name, ranges):
+    # Written aside and renamed, a checkpoint is never left half written
+    tmp_path = path + '.tmp'
+    with io.open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'source': source_name,
+                            'backfilled': [[start.isoformat(), end.isoformat()] for start, end in ranges]}))
+    # os.replace is not available on Python 2
+    getattr(os, 'replace', os.rename)(tmp_path, path)
+
+
+class Command(BaseCommand):
+    help = 'Load the historical rates of a date range for a source'
+
+    def add_arguments(self, parser):
+        parser.add_argument('backend_path', nargs='?', help='Backend to read, defaults to DEFAULT_BACKEND')
+        parser.add_argument('--start', required=True, help='First day to load, as YYYY-MM-DD')
+        parser.add_argument('--end', default=None, help='Last day to load, defaults to today')
+        parser.add_argument('--path', default=None, help='File or directory read by the file backends')
+        parser.add_argument('--chunk-days', type=int, default=30, help='Days written together')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Chunks fetched concurrently, unless the history is read from a single stream')
+        parser.add_argument('--checkpoint', default=None,
+                            help='File recording the days loaded, the backfill resumes from it')
+
+    def handle(self, *args, **options):
+        backend_path = options.get('backend_path')
+        if backend_path:
+            try:
+                backend_class = import_from_string(backend_path, "")
+            except ImportError:
+                raise CommandError("Cannot find custom backend %s. Is it correct" % backend_path)
+        else:
+            backend_class = money_rates_settings.DEFAULT_BACKEND
+
+        try:
+            if options.get('path') is not None:
+                if not issubclass(backend_class, FileRateBackend):
+                    raise CommandError("%s does not read files" % backend_class)
+                backend = backend_class(options['path'])
+            else:
+                backend = backend_class()
+        except CommandError:
+            raise
+        except Exception as e:
+            raise CommandError("Error during backfill: %s" % e)
+
+        source_name = backend.get_source_name()
+        try:
+            start = parse_date(options['start'])
+            end = parse_date(options['end']) if options.get('end') else timezone.now().date()
+        except ValueError as e:
+            raise CommandError("Invalid date: %s" % e)
+        chunk_days, workers = options['chunk_days'], options['workers']
+        if chunk_days < 1 or workers < 1:
+            raise CommandError("--chunk-days and --workers must be positive")
+
+        checkpoint = options.get('checkpoint')
+        backfilled = read_checkpoint(checkpoint, source_name) if checkpoint else []
+        chunks = [(chunk_start, chunk_end) for chunk_start, chunk_end in split_range(start, end, chunk_days)
+                  if not any(first <= chunk_start and chunk_end <= last for first, last in backfilled)]
+        if backfilled:
+            self.stdout.write('Resuming, %d chunks left' % len(chunks))
+        if not chunks:
+            self.stdout.write('Nothing to backfill for "%s"' % source_name)
+            return
+
+        if backend.is_history_streamed():
+            fetched = self.iter_streamed_chunks(backend, start, end, chunk_days, backfilled)
+        else:
+            fetched = self.iter_fetched_chunks(backend, chunks, workers)
+
+        started_at = time.time()
+        total = done = 0
+        try:
+            for (chunk_start, chunk_end), dated_rates in fetched:
+                try:
+                    with metrics.measure('backfill_rates.write', count_queries=True, source=source_name) as measure:
+                        with transaction.atomic():
+                            count = backend.save_history(dated_rates)
+                        measure.data.update(count=count)
+                except Exception as e:
+                    raise CommandError("Error during backfill from %s to %s: %s" % (chunk_start, chunk_end, e))
+
+                if checkpoint:
+                    backfilled = merge_ranges(backfilled + [(chunk_start, chunk_end)])
+                    write_checkpoint(checkpoint, source_name, backfilled)
+
+                done += 1
+                total += count
+                elapsed = time.time() - started_at
+                self.stdout.write('Backfilled %s to %s: %d rates (%d/%d chunks, %d rates/s)' % (
+                    chunk_start, chunk_end, count, done, len(chunks), total / elapsed if elapsed else 0))
+        finally:
+            # Stops the pool of workers when the backfill fails
+            fetched.close()
+
+        elapsed = time.time() - started_at
+        self.stdout.write('Successfully backfilled %d rates for "%s" in %.1f seconds (%d rates/s)' % (
+            total, source_name, elapsed, total / elapsed if elapsed else 0))
+
+    def iter_fetched_chunks(self, backend, chunks, workers):
+        """
+        Fetch 'chunks' in a pool of 'workers' threads and yield each chunk
+        with its rates, in order, so that they are written while the next
+        ones are fetched. At most two chunks per worker wait in memory.
+        """
+        def fetch(chunk):
+            return list(backend.get_historical_rates(*chunk))
+
+        pool = ThreadPool(workers)
+        pending = collections.deque()
+        queued = iter(chunks)
+        try:
+            for chunk in queued:
+                pending.append((chunk, pool.apply_async(fetch, (chunk,))))
+                if len(pending) >= 2 * workers:
+                    break
+
+            while pending:
+                chunk, result = pending.popleft()
+                for next_chunk in queued:
+                    pending.append((next_chunk, pool.apply_async(fetch, (next_chunk,))))
+                    break
+
+                try:
+                    dated_rates = result.get()
+                except Exception as e:
+                    raise CommandError("Error during backfill from %s to %s: %s" % (chunk[0], chunk[1], e))
+                yield chunk, dated_rates
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def iter_streamed_chunks(self, backend, start, end, chunk_days, backfilled):
+        """
+        Read the history of the whole range once and cut it into chunks of
+        'chunk_days' days as it is parsed. The stream is expected to be
+        sorted by date, in either order: a chunk is complete when a date of
+        another chunk is read.
+        """
+        chunk, batch = None, []
+        try:
+            for date, rates in backend.get_historical_rates(start, end):
+                if is_backfilled(backfilled, date):
+                    continue
+
+                index = (date - start).days // chunk_days
+                if index != chunk and batch:
+                    yield self._get_chunk_range(start, end, chunk_days, chunk), batch
+                    batch = []
+                chunk = index
+                batch.append((date, rates))
+        except Exception as e:
+            raise CommandError("Error during backfill: %s" % e)
+
+        if batch:
+            yield self._get_chunk_range(start, end, chunk_days, chunk), batch
+
+    def _get_chunk_range(self, start, end, chunk_days, index):
+        chunk_start = start + datetime.timedelta(days=index * chunk_days)
+        return chunk_start, min(chunk_start + datetime.timedelta(days=chunk_days - 1), end)
@@ -0,0 +1,69 @@
+from __future__ import unicode_literals
+
+import csv
+import io
+from decimal import Decimal, InvalidOperation
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import six
+
+from ...exceptions import CurrencyConversionException
+from ...utils import iter_convert
+
+
+def open_csv(path, mode):
+    # The csv module of Python 2 works on byte strings
+    if six.PY2:
+        return open(path, mode + 'b')
+    return io.open(path, mode, newline='', encoding='utf-8')
+
+
+class Command(BaseCommand):
+    help = 'Convert the amounts of a CSV file to a currency, writing them to another CSV file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help='CSV file to read, with a header row')
+        parser.add_argument('output', help='CSV file to write')
+        parser.add_argument('--to', required=True, help='Currency the amounts are converted to')
+        parser.add_argument('--amount-column', default='amount')
+        parser.add_argument('--currency-column', default='currency')
+        parser.add_argument('--output-column', default=None,
+                            help='Column of the converted amounts, defaults to amount_<currency>')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        currency_to = options['to']
+        amount_column = options['amount_column']
+        currency_column = options['currency_column']
+        output_column = options['output_column'] or 'amount_%s' % currency_to.lower()
+        if options['chunk_size'] < 1:
+            raise CommandError("--chunk-size must be positive")
+
+        def key(row):
+            line, values = row
+            try:
+                return Decimal(values[amount_column]), values[currency_column]
+            except (KeyError, InvalidOperation):
+                raise CommandError("Invalid amount or currency at line %d" % line)
+
+        count = 0
+        with open_csv(options['input'], 'r') as input_file, open_csv(options['output'], 'w') as output_file:
+            reader = csv.DictReader(input_file)
+            if amount_column not in (reader.fieldnames or ()) or currency_column not in reader.fieldnames:
+                raise CommandError("Columns %s and %s are required" % (amount_column, currency_column))
+
+            writer = csv.DictWriter(output_file, fieldnames=reader.fieldnames + [output_column])
+            writer.writeheader()
+
+            # Lines are counted from 2, after the header
+            rows = enumerate(reader, 2)
+            try:
+                for (line, values), amount in iter_convert(rows, currency_to, key=key,
+                                                           chunk_size=options['chunk_size']):
+                    values[output_column] = six.text_type(amount)
+                    writer.writerow(values)
+                    count += 1
+            except CurrencyConversionException as e:
+                raise CommandError("Error during conversion: %s" % e)
+
+        self.stdout.write('Converted %d rows to %s' % (count, currency_to))
@@ -1,29 +1,95 @@
 from __future__ import unicode_literals
 
 from django.core.management.base import BaseCommand, CommandError
+from django.utils import six
 
+from ...backends import BaseRateBackend, RatesUpdate, fetch_rates
 from ...settings import money_rates_settings, import_from_string
 
 
+def overrides_update_rates(backend):
+    """
+    Return True when the class of 'backend' overrides `update_rates`, which
+    must then be called instead of fetching and saving the rates separately
+    """
+    return six.get_unbound_function(type(backend).update_rates) is not \
+        six.get_unbound_function(BaseRateBackend.update_rates)
+
+
 class Command(BaseCommand):
-    help = 'Update rates for configured source'
+    help = 'Update rates for configured sources'
 
     def add_arguments(self, parser):
-        parser.add_argument('backend_path', nargs='?')
+        parser.add_argument('backend_path', nargs='*')
+        parser.add_argument('--deadline', type=float, default=None,
+                            help='Seconds to wait for all the backends, defaults to RATE_UPDATE_DEADLINE')
 
     def handle(self, *args, **options):
-        if 'backend_path' in options and options['backend_path']:
+        backend_classes = []
+        for backend_path in options.get('backend_path') or ():
             try:
-                backend_class = import_from_string(options['backend_path'], "")
+                backend_classes.append(import_from_string(backend_path, ""))
             except ImportError:
-                raise CommandError("Cannot find custom backend %s. Is it correct" % options['backend_path'])
-        else:
-            backend_class = money_rates_settings.DEFAULT_BACKEND
+                raise CommandError("Cannot find custom backend %s. Is it correct" % backend_path)
+
+        if not backend_classes:
+            backend_classes = money_rates_settings.RATE_BACKENDS or [money_rates_settings.DEFAULT_BACKEND]
 
         try:
-            backend = backend_class()
-            backend.update_rates()
+            backends = [backend_class() for backend_class in backend_classes]
         except Exception as e:
             raise CommandError("Error during rate update: %s" % e)
 
-        self.stdout.write('Successfully updated rates for "%s"' % backend_class)
+        deadline = options.get('deadline')
+        if deadline is None:
+            deadline = money_rates_settings.RATE_UPDATE_DEADLINE
+
+        # Rates are retrieved concurrently, then written one source at a time.
+        # Backends overriding update_rates are updated by it in their turn.
+        fetched_backends = [backend for backend in backends if not overrides_update_rates(backend)]
+        fetched = dict(zip(fetched_backends, fetch_rates(fetched_backends, deadline)))
+
+        errors = []
+        for backend in backends:
+            if backend in fetched:
+                rates, error = fetched[backend]
+                if error is None and rates is None:
+                    self.stdout.write('Rates for "%s" are not modified' % backend.__class__)
+                    continue
+
+                if error is None:
+                    try:
+                        result = backend.save_rates(rates)
+                    except Exception as e:
+                        error = e
+            else:
+                error = None
+                try:
+                    result = backend.update_rates()
+                except Exception as e:
+                    error = e
+
+            if error is not None:
+                errors.append("%s: %s" % (backend.__class__, error))
+                continue
+
+            if not isinstance(result, RatesUpdate):
+                self.stdout.write('Successfully updated rates for "%s"' % backend.__class__)
+                continue
+
+            self.stdout.write(
+                'Successfully updated rates for "%s" (%d created, %d updated, %d unchanged, %d removed)' % (
+                    backend.__class__, result.created, result.updated, result.unchanged, result.removed))
+            if int(options.get('verbosity', 1)) > 1:
+                self.write_changes(result.changes)
+
+        if errors:
+            raise CommandError("Error during rate update: %s" % "; ".join(errors))
+
+    def write_changes(self, changes):
+        for currency, value in sorted(changes.created.items()):
+            self.stdout.write('  + %s %s' % (currency, value))
+        for currency, (old_value, new_value) in sorted(changes.updated.items()):
+            self.stdout.write('  ~ %s %s -> %s' % (currency, old_value, new_value))
+        for currency, value in sorted(changes.removed.items()):
+            self.stdout.write('  - %s %s' % (currency, value))
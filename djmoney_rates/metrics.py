@@ -0,0 +1,113 @@
+from __future__ import unicode_literals
+
+"""
+Instrumentation of conversions and rate updates.
+
+Set `METRICS_CALLBACK` to a callable (or its import path) to receive the
+metrics. It is called as `callback(name, **data)` where `name` is one of:
+
+* `convert`: a conversion, with its `duration` and `queries`
+* `convert_many`: a batch conversion, with its `duration` and `queries`
+* `rate_cache.hit` / `rate_cache.miss`: a lookup of the rates of `source`
+* `update_rates.fetch`: the retrieval of the rates of `source`, with its `duration`
+* `update_rates.parse`: the parsing of the provider response, when done by the backend
+* `update_rates.write`: the write of the rates of `source`, with its `duration`,
+  `queries` and the number of `created`, `updated`, `unchanged` and `removed` rates
+* `rate_refresh`: the background refresh of the stale rates of `source`, with its
+  `duration` and whether the rates were `modified`
+* `backfill_rates.write`: the write of a chunk of historical rates of `source`,
+  with its `duration`, `queries` and the `count` of rates recorded
+
+When no callback is configured the instrumented code only pays a setting lookup.
+"""
+
+import functools
+import logging
+import time
+
+from django.db import connection
+
+from .settings import money_rates_settings
+
+
+logger = logging.getLogger(__name__)
+
+
+def is_enabled():
+    return money_rates_settings.METRICS_CALLBACK is not None
+
+
+def emit(name, **data):
+    """
+    Send a metric to the configured callback, if any
+    """
+    callback = money_rates_settings.METRICS_CALLBACK
+    if callback is None:
+        return
+
+    try:
+        callback(name, **data)
+    except Exception:
+        logger.exception("Error sending the metric %s", name)
+
+
+class QueryCounter(object):
+    """
+    Count the queries run on the default database connection
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class measure(object):
+    """
+    Context manager that emits the metric 'name' with the duration and the
+    queries of its block, together with the items added to `data`.
+    """
+
+    def __init__(self, name, count_queries=False, **data):
+        self.name = name
+        self.data = data
+        self.counter = None
+        self.wrapper = None
+        self.count_queries = count_queries
+
+    def __enter__(self):
+        # Connection.execute_wrapper is only available since Django 2.0
+        if self.count_queries and is_enabled() and hasattr(connection, 'execute_wrapper'):
+            self.counter = QueryCounter()
+            self.wrapper = connection.execute_wrapper(self.counter)
+            self.wrapper.__enter__()
+        self.started_at = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.time() - self.started_at
+        if self.wrapper is not None:
+            self.wrapper.__exit__(exc_type, exc_value, traceback)
+
+        if exc_type is None:
+            queries = self.counter.count if self.counter is not None else None
+            emit(self.name, duration=duration, queries=queries, **self.data)
+
+
+def instrumented(name):
+    """
+    Decorator that measures the calls of the decorated function as 'name'
+    when metrics are enabled.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if money_rates_settings.METRICS_CALLBACK is None:
+                return func(*args, **kwargs)
+
+            with measure(name, count_queries=True):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,29 @@
+from __future__ import unicode_literals
+
+from .cache import rates_snapshot
+
+
+class RatesSnapshotMiddleware(object):
+    """
+    Convert all the amounts of a request with the same rates, read at most
+    once per source.
+
+    Works both in MIDDLEWARE and in the old-style MIDDLEWARE_CLASSES.
+    """
+
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with rates_snapshot():
+            return self.get_response(request)
+
+    def process_request(self, request):
+        request._rates_snapshot = rates_snapshot().__enter__()
+
+    def process_response(self, request, response):
+        snapshot = getattr(request, '_rates_snapshot', None)
+        if snapshot is not None:
+            snapshot.__exit__(None, None, None)
+            del request._rates_snapshot
+        return response
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 07:38
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateSource',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('last_update', models.DateTimeField(auto_now=True)),
+                ('base_currency', models.CharField(max_length=3)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Rate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('currency', models.CharField(max_length=3)),
+                ('value', models.DecimalField(decimal_places=6, max_digits=20)),
+                ('source', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE, to='djmoney_rates.RateSource')),
+            ],
+            options={
+                'unique_together': {('source', 'currency')},
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 07:38
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djmoney_rates', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ratesource',
+            name='http_etag',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='ratesource',
+            name='http_last_modified',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='ratesource',
+            name='rates_timestamp',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='HistoricalRate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('currency', models.CharField(max_length=3)),
+                ('value', models.DecimalField(decimal_places=6, max_digits=20)),
+                ('effective_at', models.DateTimeField()),
+                ('source', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE, to='djmoney_rates.RateSource')),
+            ],
+            options={
+                'get_latest_by': 'effective_at',
+                'unique_together': {('source', 'currency', 'effective_at')},
+            },
+        ),
+    ]
@@ -10,6 +10,11 @@ class RateSource(models.Model):
     name = models.CharField(max_length=100, unique=True)
     last_update = models.DateTimeField(auto_now=True)
     base_currency = models.CharField(max_length=3)
+    # Validators of the last rates retrieved from the provider, used by
+    # backends to skip the update when the provider data did not change
+    http_etag = models.CharField(max_length=255, blank=True, default='')
+    http_last_modified = models.CharField(max_length=64, blank=True, default='')
+    rates_timestamp = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return _("%s rates in %s update %s") % (
@@ -27,3 +32,19 @@ class Rate(models.Model):
 
     def __str__(self):
         return _("%s at %.6f") % (self.currency, self.value)
+
+
+@python_2_unicode_compatible
+class HistoricalRate(models.Model):
+    source = models.ForeignKey(RateSource, on_delete=models.CASCADE)
+    currency = models.CharField(max_length=3)
+    value = models.DecimalField(max_digits=20, decimal_places=6)
+    effective_at = models.DateTimeField()
+
+    class Meta:
+        # The unique index on these columns serves point-in-time lookups
+        unique_together = ('source', 'currency', 'effective_at')
+        get_latest_by = 'effective_at'
+
+    def __str__(self):
+        return _("%s at %.6f since %s") % (self.currency, self.value, self.effective_at)
@@ -0,0 +1,195 @@
+from __future__ import unicode_literals
+
+"""
+Stale-while-revalidate refresh of the rates, instead of (or alongside) a
+cron running `update_rates`.
+
+When `RATE_REFRESH_ENABLED` is set, the rate cache compares the
+`last_update` of a source with its max age each time it checks the source
+version (see `RATE_CACHE_CHECK_INTERVAL`). When the rates are older, the
+backend writing the source updates it in a background thread while the
+conversions keep using the cached rates: no request waits for the provider.
+
+A single refresh of a source runs at a time: the threads of a process are
+serialized by a lock and processes by a lock in the Django cache named by
+`RATE_REFRESH_CACHE_ALIAS`, which must be shared between the processes
+(e.g. Memcached or Redis). A refresh that fails, or finds the rates not
+modified, is not attempted again before `RATE_REFRESH_RETRY_INTERVAL`.
+"""
+
+import datetime
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from django.core.cache import caches
+from django.db import connections
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+from django.utils import timezone
+
+from . import metrics
+from .models import RateSource
+from .settings import money_rates_settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class RateRefresher(object):
+    """
+    Schedules the background refresh of the sources whose rates are stale
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Refresh threads running in this process, by source name
+        self._threads = {}
+        # Time of the last refresh attempted by this process, by source name
+        self._attempted_at = {}
+        # Backend class writing each source, None when not configured
+        self._backend_classes = {}
+
+    def get_max_age(self, source_name):
+        """
+        Return the seconds after which the rates of 'source_name' are stale
+        """
+        return money_rates_settings.RATE_REFRESH_MAX_AGES.get(source_name, money_rates_settings.RATE_REFRESH_MAX_AGE)
+
+    def is_stale(self, source_name, last_update):
+        return timezone.now() - last_update > datetime.timedelta(seconds=self.get_max_age(source_name))
+
+    def check(self, table):
+        """
+        Schedule a refresh of the source of the `CachedRates` 'table' when
+        its rates are stale. Return the refresh thread, or None.
+        """
+        source_id, base_currency, last_update = table.version
+        if not self.is_stale(table.source_name, last_update):
+            return None
+        return self.schedule(table.source_name)
+
+    def schedule(self, source_name):
+        """
+        Start a refresh of 'source_name' in a background thread, unless one
+        is running or was attempted less than `RATE_REFRESH_RETRY_INTERVAL`
+        seconds ago. Return the thread started, or None.
+        """
+        now = time.time()
+        with self._lock:
+            if source_name in self._threads:
+                return None
+            attempted_at = self._attempted_at.get(source_name)
+            if attempted_at is not None and now - attempted_at < money_rates_settings.RATE_REFRESH_RETRY_INTERVAL:
+                return None
+
+            backend_class = self.get_backend_class(source_name)
+            if backend_class is None:
+                logger.debug("No backend configured to refresh %s", source_name)
+                return None
+
+            self._attempted_at[source_name] = now
+            thread = threading.Thread(target=self._run, args=(source_name, backend_class))
+            # A pending refresh must not keep the process alive
+            thread.daemon = True
+            self._threads[source_name] = thread
+
+        thread.start()
+        return thread
+
+    def get_backend_class(self, source_name):
+        """
+        Return the class of the configured backend writing 'source_name', or
+        None. Backends are looked up in `RATE_SOURCES`, `RATE_BACKENDS` and
+        `DEFAULT_BACKEND`.
+        """
+        try:
+            return self._backend_classes[source_name]
+        except KeyError:
+            pass
+
+        backend_classes = list(money_rates_settings.RATE_SOURCES or ())
+        backend_classes.extend(money_rates_settings.RATE_BACKENDS or ())
+        backend_classes.append(money_rates_settings.DEFAULT_BACKEND)
+        for backend_class in backend_classes:
+            try:
+                if backend_class().get_source_name() == source_name:
+                    break
+            except Exception:
+                logger.warning("Cannot instantiate %s", backend_class, exc_info=True)
+        else:
+            backend_class = None
+
+        self._backend_classes[source_name] = backend_class
+        return backend_class
+
+    def refresh(self, source_name, backend_class):
+        """
+        Update 'source_name' with 'backend_class' if no other process is
+        refreshing it and its rates are still stale. Return the result of
+        `update_rates`, or None when the refresh was skipped.
+        """
+        cache = caches[money_rates_settings.RATE_REFRESH_CACHE_ALIAS]
+        lock_key = self.get_lock_key(source_name)
+        # The lock expires by itself, so that a process dying during the
+        # refresh does not block the others
+        timeout = max(money_rates_settings.RATE_REFRESH_RETRY_INTERVAL, 1)
+        if not cache.add(lock_key, os.getpid(), timeout):
+            logger.debug("Rates of %s are refreshed by another process", source_name)
+            return None
+
+        # Another process may have refreshed the rates in the meantime
+        last_update = RateSource.objects.filter(name=source_name).values_list('last_update', flat=True).first()
+        if last_update is not None and not self.is_stale(source_name, last_update):
+            cache.delete(lock_key)
+            return None
+
+        with metrics.measure('rate_refresh', source=source_name) as measure:
+            result = backend_class().update_rates()
+            measure.data.update(modified=result is not None)
+
+        # Failed refreshes, and the not modified ones, keep the lock until it
+        # expires so that the provider is not asked again right away
+        if result is not None:
+            cache.delete(lock_key)
+        return result
+
+    def get_lock_key(self, source_name):
+        # Source names are hashed as in the keys of the shared rate cache
+        return 'djmoney_rates:refresh:%s' % hashlib.md5(source_name.encode('utf-8')).hexdigest()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the refreshes running in this process to complete
+        """
+        with self._lock:
+            threads = list(self._threads.values())
+        for thread in threads:
+            thread.join(timeout)
+
+    def reset(self):
+        with self._lock:
+            self._attempted_at.clear()
+            self._backend_classes.clear()
+
+    def _run(self, source_name, backend_class):
+        try:
+            self.refresh(source_name, backend_class)
+        except Exception:
+            logger.exception("Error refreshing the rates of %s", source_name)
+        finally:
+            with self._lock:
+                del self._threads[source_name]
+            # The connections opened by this thread would never be reused
+            connections.close_all()
+
+
+rate_refresher = RateRefresher()
+
+
+@receiver(setting_changed)
+def _reset_refresher(setting, **kwargs):
+    if setting == 'DJANGO_MONEY_RATES':
+        rate_refresher.reset()
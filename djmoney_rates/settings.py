@@ -12,10 +12,15 @@ DJANGO_MONEY_RATES = {
 
 This module provides the `money_rates_settings` object, that is used to access
 django-money-rates settings, checking for user settings first, then falling
-back to the defaults.
+back to the defaults. Settings are read on first access and read again when
+DJANGO_MONEY_RATES changes, e.g. with `override_settings`.
 """
 
+import decimal
+
 from django.conf import settings
+from django.dispatch import receiver
+from django.test.signals import setting_changed
 
 try:
     from django.utils import importlib, six
@@ -24,14 +29,75 @@ except ImportError:
     import six
 
 
-USER_SETTINGS = getattr(settings, 'DJANGO_MONEY_RATES', None)
-
 DEFAULTS = {
     'DEFAULT_BACKEND': 'djmoney_rates.backends.OpenExchangeBackend',
 
     'OPENEXCHANGE_URL': 'http://openexchangerates.org/api/latest.json',
+    # Prefix of the daily rates read by the backfill_rates command
+    'OPENEXCHANGE_HISTORICAL_URL': 'http://openexchangerates.org/api/historical/',
     'OPENEXCHANGE_APP_ID': '',
     'OPENEXCHANGE_BASE_CURRENCY': 'USD',
+
+    # Backends updated by the update_rates command, defaults to DEFAULT_BACKEND
+    'RATE_BACKENDS': (),
+    # Seconds each backend is allowed to take to retrieve its rates
+    'RATE_FETCH_TIMEOUT': 30,
+    # Seconds the update_rates command waits for all the backends
+    'RATE_UPDATE_DEADLINE': 120,
+
+    # Backends whose sources are used for conversion, in order of priority:
+    # each currency is read from the first source providing it. Defaults to
+    # the source of DEFAULT_BACKEND only.
+    'RATE_SOURCES': (),
+
+    # Relative change below which a stored rate is not updated, e.g. 0.0001
+    # ignores changes smaller than 0.01%. Changes of any size are written when 0.
+    'RATE_CHANGE_EPSILON': 0,
+
+    # Record every rate change in HistoricalRate during update_rates
+    'RATE_HISTORY_ENABLED': True,
+
+    # Rounding mode of the converted amounts, one of the decimal.ROUND_* constants
+    'ROUNDING': decimal.ROUND_HALF_EVEN,
+    # Decimal places of the converted amounts by currency code, overriding the
+    # ones of the currency (e.g. {'JPY': 0})
+    'CURRENCY_DECIMAL_PLACES': {},
+
+    # In-process cache of the rate tables used by the conversion utilities
+    'RATE_CACHE_ENABLED': True,
+    # Seconds between two checks of the cached tables against the database.
+    # A value of 0 checks the RateSource on every conversion.
+    'RATE_CACHE_CHECK_INTERVAL': 60,
+    # Number of sources whose rates are kept in the cache, the least recently
+    # used are evicted. The number of sources is not limited when 0.
+    'RATE_CACHE_MAX_SOURCES': 64,
+    # Convert with a single multiplication by a cached cross rate. Results
+    # may differ from the default arithmetic only when the exact converted
+    # amount lies within rounding noise of half a cent.
+    'CROSS_RATES_ENABLED': False,
+    # Number of most recently used currency pairs kept for each source
+    'CROSS_RATES_MAX_PAIRS': 1024,
+    # Alias of the Django cache where the rate tables are shared between
+    # processes. The shared cache is not used when empty.
+    'SHARED_CACHE_ALIAS': None,
+    'SHARED_CACHE_TIMEOUT': 3600,
+    # Read the rates from the database when they are not in the shared cache
+    'SHARED_CACHE_FALLBACK': True,
+
+    # Refresh the rates of a source in a background thread, while they keep
+    # being used, when they are older than their max age. See djmoney_rates.refresh
+    'RATE_REFRESH_ENABLED': False,
+    # Seconds after the last update of a source its rates are stale
+    'RATE_REFRESH_MAX_AGE': 3600,
+    # Max ages by source name, overriding RATE_REFRESH_MAX_AGE
+    'RATE_REFRESH_MAX_AGES': {},
+    # Seconds before a refresh that failed, or found the rates not modified, is retried
+    'RATE_REFRESH_RETRY_INTERVAL': 300,
+    # Alias of the Django cache holding the lock that lets a single process refresh a source
+    'RATE_REFRESH_CACHE_ALIAS': 'default',
+
+    # Callable receiving the metrics of conversions and updates, see djmoney_rates.metrics
+    'METRICS_CALLBACK': None,
 }
 
 # List of settings that cannot be empty
@@ -42,6 +108,9 @@ MANDATORY = (
 # List of settings that may be in string import notation.
 IMPORT_STRINGS = (
     'DEFAULT_BACKEND',
+    'RATE_BACKENDS',
+    'RATE_SOURCES',
+    'METRICS_CALLBACK',
 )
 
 
@@ -73,20 +142,30 @@ def import_from_string(val, setting_name):
 
 class MoneyRatesSettings(object):
     """
-    A settings object, that allows Bazaar settings to be accessed as properties.
+    A settings object, that allows django-money-rates settings to be accessed as properties.
 
     Any setting with string import paths will be automatically resolved
-    and return the class, rather than the string literal.
+    and return the class, rather than the string literal. Settings are
+    resolved on first access and stored as attributes, so that further
+    accesses are plain attribute lookups, until `reload` is called.
     """
 
     def __init__(self, user_settings=None, defaults=None, import_strings=None, mandatory=None):
-        self.user_settings = user_settings or {}
+        # User settings are read from the Django settings when not given
+        self._given_user_settings = user_settings
+        self._user_settings = user_settings
         self.defaults = defaults or {}
-        self.import_strings = import_strings or ()
-        self.mandatory = mandatory or ()
+        self.import_strings = frozenset(import_strings or ())
+        self.mandatory = frozenset(mandatory or ())
+
+    @property
+    def user_settings(self):
+        if self._user_settings is None:
+            self._user_settings = getattr(settings, 'DJANGO_MONEY_RATES', None) or {}
+        return self._user_settings
 
     def __getattr__(self, attr):
-        if attr not in self.defaults.keys():
+        if attr not in self.defaults:
             raise AttributeError("Invalid django-money-rates setting: '%s'" % attr)
 
         try:
@@ -103,12 +182,26 @@ class MoneyRatesSettings(object):
         self.validate_setting(attr, val)
 
         # Cache the result
-        setattr(self, attr, val)
+        self.__dict__[attr] = val
         return val
 
     def validate_setting(self, attr, val):
         if not val and attr in self.mandatory:
             raise AttributeError("django-money-rates setting: '%s' is mandatory" % attr)
 
+    def reload(self):
+        """
+        Drop the resolved settings, including the ones assigned directly
+        """
+        for attr in self.defaults:
+            self.__dict__.pop(attr, None)
+        self._user_settings = self._given_user_settings
+
+
+money_rates_settings = MoneyRatesSettings(None, DEFAULTS, IMPORT_STRINGS, MANDATORY)
+
 
-money_rates_settings = MoneyRatesSettings(USER_SETTINGS, DEFAULTS, IMPORT_STRINGS, MANDATORY)
+@receiver(setting_changed)
+def reload_money_rates_settings(setting, **kwargs):
+    if setting == 'DJANGO_MONEY_RATES':
+        money_rates_settings.reload()
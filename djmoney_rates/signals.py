@@ -0,0 +1,9 @@
+from __future__ import unicode_literals
+
+from django.dispatch import Signal
+
+
+# Sent by `BaseRateBackend.update_rates` once all the rates of a source have
+# been written. Receivers get the updated `source` and the `changes` written,
+# a `djmoney_rates.backends.RateChanges`, as keyword arguments.
+rates_updated = Signal()
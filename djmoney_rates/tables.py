@@ -0,0 +1,309 @@
+from __future__ import unicode_literals
+
+"""
+Compact immutable snapshots of the rates of a source.
+"""
+
+import bisect
+from decimal import (
+    ROUND_CEILING, ROUND_DOWN, ROUND_FLOOR, ROUND_HALF_DOWN, ROUND_HALF_EVEN, ROUND_HALF_UP, ROUND_UP, Decimal)
+
+from django.utils import six
+from django.utils.six.moves import zip
+
+import moneyed
+
+from .exceptions import CurrencyConversionException
+from .settings import money_rates_settings
+
+
+ONE = Decimal(1)
+MICRO = Decimal('.000001')
+CENTS = Decimal('.01')
+
+# Decimal places of the ISO 4217 currencies whose minor unit is not the
+# hundredth, for the versions of moneyed that don't provide them.
+ISO_DECIMAL_PLACES = {
+    'BHD': 3, 'BIF': 0, 'CLF': 4, 'CLP': 0, 'DJF': 0, 'GNF': 0, 'IQD': 3, 'ISK': 0, 'JOD': 3,
+    'JPY': 0, 'KMF': 0, 'KRW': 0, 'KWD': 3, 'LYD': 3, 'OMR': 3, 'PYG': 0, 'RWF': 0, 'TND': 3,
+    'UGX': 0, 'UYI': 0, 'UYW': 4, 'VND': 0, 'VUV': 0, 'XAF': 0, 'XOF': 0, 'XPF': 0,
+}
+
+# Quantum of each currency, with the overrides it was computed with
+_quanta = {}
+
+
+def get_decimal_places(currency):
+    """
+    Return the number of decimal places of the amounts in 'currency'
+    """
+    overrides = money_rates_settings.CURRENCY_DECIMAL_PLACES
+    if currency in overrides:
+        return overrides[currency]
+
+    # moneyed >= 0.7 provides the minor unit of the currencies
+    sub_unit = getattr(moneyed.CURRENCIES.get(currency), 'sub_unit', None)
+    if sub_unit:
+        return len(str(sub_unit)) - 1
+    return ISO_DECIMAL_PLACES.get(currency, 2)
+
+
+def get_quantum(currency):
+    """
+    Return the Decimal the amounts in 'currency' are quantized to, e.g.
+    `Decimal('0.01')` for EUR and `Decimal('1')` for JPY
+    """
+    overrides = money_rates_settings.CURRENCY_DECIMAL_PLACES
+    try:
+        cached_overrides, quantum = _quanta[currency]
+    except KeyError:
+        cached_overrides = quantum = None
+
+    if quantum is None or cached_overrides is not overrides:
+        quantum = ONE.scaleb(-get_decimal_places(currency))
+        _quanta[currency] = (overrides, quantum)
+    return quantum
+
+
+def clean_amount(amount):
+    """
+    Return 'amount' as a Decimal suitable for conversion
+    """
+    if isinstance(amount, float):
+        amount = Decimal(amount).quantize(MICRO)
+    return amount
+
+
+def quantize_amount(amount, currency=None):
+    """
+    Round 'amount' to the decimal places of 'currency', or to two decimal
+    places if not given, with the configured rounding mode
+    """
+    quantum = CENTS if currency is None else get_quantum(currency)
+    return amount.quantize(quantum, rounding=money_rates_settings.ROUNDING)
+
+
+def convert_amount(amount, rate_from, rate_to, currency=None):
+    """
+    Convert 'amount' using the given rates and round it for 'currency'
+    """
+    return quantize_amount((clean_amount(amount) / rate_from) * rate_to, currency)
+
+
+# Rates are stored with 6 decimal places, see `Rate.value`.
+RATE_SCALE = 10 ** 6
+
+# The two operations of `convert_amount` round their results to 28
+# significant digits, so that its relative error is below 10 ** -27. When the
+# exact result is farther than that from a rounding boundary both paths round
+# it the same way, otherwise the Decimal path is used.
+_TIE_MARGIN = 10 ** 26
+
+# Above this magnitude `quantize` of the Decimal path runs out of precision.
+_MAX_MINOR_UNITS = 10 ** 26
+
+_HALF_ROUNDINGS = (ROUND_HALF_EVEN, ROUND_HALF_UP, ROUND_HALF_DOWN)
+_DIRECTED_ROUNDINGS = (ROUND_DOWN, ROUND_UP, ROUND_FLOOR, ROUND_CEILING)
+
+
+def scale_rate(rate):
+    """
+    Return 'rate' as an integer number of millionths, or None if it has more
+    than 6 decimal places
+    """
+    scaled = rate.scaleb(6)
+    if scaled != scaled.to_integral_value() or scaled <= 0:
+        return None
+    return int(scaled)
+
+
+def convert_minor_units(amount, scaled_from, scaled_to, shift=0, rounding=ROUND_HALF_EVEN):
+    """
+    Convert the integer 'amount' of minor units using rates scaled by
+    `RATE_SCALE`, rounding like `convert_amount`. 'shift' is the number of
+    decimal places of the target currency minus the ones of the source.
+
+    Return None when the integer result may differ from the one of
+    `convert_amount`, that is when it is too close to a rounding boundary.
+    """
+    numerator = abs(amount) * scaled_to
+    denominator = scaled_from
+    if shift > 0:
+        numerator *= 10 ** shift
+    elif shift < 0:
+        denominator *= 10 ** -shift
+
+    quotient, remainder = divmod(numerator, denominator)
+    if quotient >= _MAX_MINOR_UNITS:
+        return None
+
+    if rounding in _HALF_ROUNDINGS:
+        if abs(2 * remainder - denominator) * _TIE_MARGIN <= 2 * numerator:
+            return None
+        round_up = 2 * remainder > denominator
+    elif rounding in _DIRECTED_ROUNDINGS:
+        if min(remainder, denominator - remainder) * _TIE_MARGIN <= numerator:
+            return None
+        # Away from zero, toward the infinity of the sign of the amount
+        round_up = rounding == ROUND_UP or rounding == (ROUND_FLOOR if amount < 0 else ROUND_CEILING)
+    else:
+        return None
+
+    if round_up:
+        quotient += 1
+    return -quotient if amount < 0 else quotient
+
+
+class BaseRates(object):
+    """
+    Base class of the objects that provide the rates of a source.
+
+    Subclasses set `source_name` and `base_currency` and implement `get_rate`.
+    """
+    __slots__ = ()
+
+    source_name = None
+    base_currency = None
+
+    def get_rate(self, currency):
+        raise NotImplementedError
+
+    def get_pair_rates(self, currency_from, currency_to):
+        """
+        Return the rates of 'currency_from' and 'currency_to'
+        """
+        # Get rate for currency_from.
+        if self.base_currency != currency_from:
+            rate_from = self.get_rate(currency_from)
+        else:
+            # If currency from is the same as base currency its rate is 1.
+            rate_from = ONE
+
+        # Get rate for currency_to.
+        rate_to = self.get_rate(currency_to)
+
+        return rate_from, rate_to
+
+    def get_scaled_pair_rates(self, currency_from, currency_to):
+        """
+        Return the rates of 'currency_from' and 'currency_to' scaled by
+        `RATE_SCALE`, None for the rates with more than 6 decimal places
+        """
+        rate_from, rate_to = self.get_pair_rates(currency_from, currency_to)
+        return scale_rate(rate_from), scale_rate(rate_to)
+
+    def convert_minor_units_many(self, amounts, currency_from, currency_to):
+        """
+        Convert the integer 'amounts' of minor units of 'currency_from' (e.g.
+        cents) into minor units of 'currency_to' with integer arithmetic.
+
+        The results are the ones of `convert_amount` on the amounts in major
+        units, expressed in minor units.
+        """
+        scaled_from, scaled_to = self.get_scaled_pair_rates(currency_from, currency_to)
+        places_from = get_decimal_places(currency_from)
+        places_to = get_decimal_places(currency_to)
+        rounding = money_rates_settings.ROUNDING
+
+        rates = None
+        results = []
+        for amount in amounts:
+            result = None
+            if scaled_from is not None and scaled_to is not None:
+                result = convert_minor_units(amount, scaled_from, scaled_to, places_to - places_from, rounding)
+            if result is None:
+                if rates is None:
+                    rates = self.get_pair_rates(currency_from, currency_to)
+                result = convert_amount(Decimal(amount).scaleb(-places_from), rates[0], rates[1], currency_to)
+                result = int(result.scaleb(places_to))
+            results.append(result)
+        return results
+
+    def convert_minor_units(self, amount, currency_from, currency_to):
+        """
+        Convert the integer 'amount' of minor units of 'currency_from' into
+        minor units of 'currency_to' with integer arithmetic
+        """
+        return self.convert_minor_units_many((amount,), currency_from, currency_to)[0]
+
+
+class RateTable(BaseRates):
+    """
+    The rates of a source at a given version.
+
+    Currencies are kept in a sorted tuple and their rates in a parallel
+    tuple, so that a table costs a few objects whatever the number of
+    currencies and pickles as two tuples. Tables can't be modified.
+    """
+    __slots__ = ('source_name', 'source_id', 'base_currency', 'version', 'currencies', 'values')
+
+    def __init__(self, source_name, source_id, base_currency, version, rates):
+        items = sorted(six.iteritems(rates) if isinstance(rates, dict) else rates)
+        currencies = tuple(currency for currency, value in items)
+        values = tuple(value for currency, value in items)
+
+        for name, value in zip(self.__slots__, (source_name, source_id, base_currency, version,
+                                                currencies, values)):
+            object.__setattr__(self, name, value)
+
+    @classmethod
+    def from_source(cls, source, version=None):
+        """
+        Load the rates of the `RateSource` 'source' with a single query
+        """
+        from .models import Rate
+
+        rates = Rate.objects.filter(source_id=source.pk).values_list('currency', 'value')
+        return cls(source.name, source.pk, source.base_currency, version, rates)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RateTable objects are immutable")
+
+    def __reduce__(self):
+        return (self.__class__, (self.source_name, self.source_id, self.base_currency, self.version,
+                                 tuple(zip(self.currencies, self.values))))
+
+    def __len__(self):
+        return len(self.currencies)
+
+    def __contains__(self, currency):
+        index = bisect.bisect_left(self.currencies, currency)
+        return index < len(self.currencies) and self.currencies[index] == currency
+
+    def __eq__(self, other):
+        if not isinstance(other, RateTable):
+            return NotImplemented
+        return self.__reduce__()[1] == other.__reduce__()[1]
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def items(self):
+        return zip(self.currencies, self.values)
+
+    def get_rate(self, currency):
+        index = bisect.bisect_left(self.currencies, currency)
+        if index == len(self.currencies) or self.currencies[index] != currency:
+            raise CurrencyConversionException(
+                "Rate for %s in %s do not exists. "
+                "Please run python manage.py update_rates" % (
+                    currency, self.source_name))
+        return self.values[index]
+
+    rate = get_rate
+
+    def convert(self, amount, currency_from, currency_to):
+        """
+        Convert 'amount' from 'currency_from' to 'currency_to'
+        """
+        rate_from, rate_to = self.get_pair_rates(currency_from, currency_to)
+        return convert_amount(amount, rate_from, rate_to, currency_to)
+
+    def convert_many(self, amounts, currency_from, currency_to):
+        """
+        Convert all the 'amounts' from 'currency_from' to 'currency_to'
+        """
+        rate_from, rate_to = self.get_pair_rates(currency_from, currency_to)
+        return [convert_amount(amount, rate_from, rate_to, currency_to) for amount in amounts]
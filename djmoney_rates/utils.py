@@ -1,64 +1,303 @@
 from __future__ import unicode_literals
 
-from decimal import Decimal
+import datetime
+import itertools
+from collections import namedtuple
 
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+from django.utils import six
+from django.utils.six.moves import zip
+
+from .cache import ContextVar, rate_cache, rates_snapshot  # noqa
 from .exceptions import CurrencyConversionException
-from .models import Rate, RateSource
+from .history import RateHistory, RatesAt
+from .metrics import instrumented, measure
+from .models import RateSource
 from .settings import money_rates_settings
+from .tables import clean_amount, convert_amount, get_quantum, quantize_amount
 
 import moneyed
 
 
-def get_rate(currency):
+# Name and base currency of the source a backend writes to
+SourceDescriptor = namedtuple('SourceDescriptor', ['name', 'base_currency'])
+
+_source_descriptors = {}
+
+# Name of the source selected by the current `use_rate_source` block
+_current_source = ContextVar('djmoney_rates_current_source', default=None)
+
+
+class use_rate_source(object):
+    """
+    Context manager that makes the conversions of its block use the rates
+    of the `RateSource` named 'source_name', unless another source is
+    passed explicitly. It is local to the current thread or asyncio task.
+    """
+
+    def __init__(self, source_name):
+        self.source_name = source_name
+
+    def __enter__(self):
+        self._token = _current_source.set(self.source_name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current_source.reset(self._token)
+
+
+def get_rate(currency, source=None):
     """Returns the rate from the default currency to `currency`."""
-    source = get_rate_source()
-    try:
-        return Rate.objects.get(source=source, currency=currency).value
-    except Rate.DoesNotExist:
-        raise CurrencyConversionException(
-            "Rate for %s in %s do not exists. "
-            "Please run python manage.py update_rates" % (
-                currency, source.name))
+    return get_cached_rates(source).get_rate(currency)
+
+
+def get_cached_rates(source=None):
+    """
+    Return the cached rates of the Rate Source named 'source', of the one
+    selected by `use_rate_source`, or of the default Rate Source (the merged
+    rates of the `RATE_SOURCES` if configured).
+    """
+    source_names = get_source_names(source)
+    if len(source_names) == 1:
+        return rate_cache.get(source_names[0])
+    return rate_cache.get_merged(source_names)
+
+
+def get_source_names(source=None):
+    """
+    Return the names of the sources used for conversion, in order of priority
+    """
+    if source is None:
+        source = _current_source.get()
+    if source is not None:
+        return (source,)
 
+    backend_classes = money_rates_settings.RATE_SOURCES
+    if not backend_classes:
+        return (get_source_descriptor().name,)
+    return tuple(get_source_descriptor(backend_class).name for backend_class in backend_classes)
 
-def get_rate_source():
-    """Get the default Rate Source and return it."""
-    backend = money_rates_settings.DEFAULT_BACKEND()
+
+def get_rate_source(source=None):
+    """Get the Rate Source named 'source', or the default one, and return it."""
+    source_name = get_source_names(source)[0]
     try:
-        return RateSource.objects.get(name=backend.get_source_name())
+        return RateSource.objects.get(name=source_name)
     except RateSource.DoesNotExist:
         raise CurrencyConversionException(
             "Rate for %s source do not exists. "
-            "Please run python manage.py update_rates" % backend.get_source_name())
+            "Please run python manage.py update_rates" % source_name)
 
 
-def base_convert_money(amount, currency_from, currency_to):
+def get_source_descriptor(backend_class=None):
     """
-    Convert 'amount' from 'currency_from' to 'currency_to'
+    Return the `SourceDescriptor` of 'backend_class', or of the default
+    backend if not given.
+
+    Backends are instantiated only the first time their descriptor is requested.
     """
-    source = get_rate_source()
+    if backend_class is None:
+        backend_class = money_rates_settings.DEFAULT_BACKEND
+
+    try:
+        return _source_descriptors[backend_class]
+    except KeyError:
+        backend = backend_class()
+        descriptor = SourceDescriptor(backend.get_source_name(), backend.get_base_currency())
+        _source_descriptors[backend_class] = descriptor
+        return descriptor
+
+
+@receiver(setting_changed)
+def _reset_source_descriptors(setting, **kwargs):
+    if setting == 'DJANGO_MONEY_RATES':
+        _source_descriptors.clear()
+
+
+def convert_amount_with_cross_rate(amount, cross_rate, currency=None):
+    """
+    Convert 'amount' using a cross rate and round it for 'currency'
+    """
+    return quantize_amount(clean_amount(amount) * cross_rate, currency)
+
+
+def get_converter(rates, currency_from, currency_to):
+    """
+    Return a function that converts an amount from 'currency_from' to
+    'currency_to' using 'rates'
+    """
+    # The quantum and the rounding are looked up once for all the amounts
+    quantum = get_quantum(currency_to)
+    rounding = money_rates_settings.ROUNDING
+
+    if money_rates_settings.CROSS_RATES_ENABLED:
+        cross_rate = rates.get_cross_rate(currency_from, currency_to)
+        return lambda amount: (clean_amount(amount) * cross_rate).quantize(quantum, rounding=rounding)
+
+    rate_from, rate_to = rates.get_pair_rates(currency_from, currency_to)
+    return lambda amount: ((clean_amount(amount) / rate_from) * rate_to).quantize(quantum, rounding=rounding)
+
+
+def get_rates_at(at, source=None):
+    """
+    Return the rates of the Rate Source valid at the moment 'at'
+    """
+    rates = get_cached_rates(source)
+    return RatesAt(rates.source_name, rates.source_id, rates.base_currency, at)
 
-    # Get rate for currency_from.
-    if source.base_currency != currency_from:
-        rate_from = get_rate(currency_from)
-    else:
-        # If currency from is the same as base currency its rate is 1.
-        rate_from = Decimal(1)
 
-    # Get rate for currency_to.
-    rate_to = get_rate(currency_to)
+def get_rate_history(start, end, currencies=None, source=None):
+    """
+    Return the rates of the Rate Source between 'start' and 'end'
+    """
+    rates = get_cached_rates(source)
+    return RateHistory(rates.source_name, rates.source_id, rates.base_currency, start, end, currencies)
+
 
-    if isinstance(amount, float):
-        amount = Decimal(amount).quantize(Decimal('.000001'))
+@instrumented('convert')
+def base_convert_money(amount, currency_from, currency_to, at=None, source=None):
+    """
+    Convert 'amount' from 'currency_from' to 'currency_to' using the latest
+    rates, or the rates valid at the moment 'at' if given.
+
+    'source' is the name of the Rate Source to use, see `get_cached_rates`.
+    """
+    if at is not None:
+        rate_from, rate_to = get_rates_at(at, source).get_pair_rates(currency_from, currency_to)
+        return convert_amount(amount, rate_from, rate_to, currency_to)
 
-    # After finishing the operation, quantize down final amount to two points.
-    return ((amount / rate_from) * rate_to).quantize(Decimal("1.00"))
+    return get_converter(get_cached_rates(source), currency_from, currency_to)(amount)
 
 
-def convert_money(amount, currency_from, currency_to):
+def convert_money(amount, currency_from, currency_to, at=None, source=None):
     """
     Convert 'amount' from 'currency_from' to 'currency_to' and return a Money
     instance of the converted amount.
     """
-    new_amount = base_convert_money(amount, currency_from, currency_to)
+    new_amount = base_convert_money(amount, currency_from, currency_to, at, source)
     return moneyed.Money(new_amount, currency_to)
+
+
+@instrumented('convert_many')
+def convert_money_many(amounts, currencies_from, currencies_to, as_decimal=False, at=None, source=None):
+    """
+    Convert every amount in 'amounts' and return a list with the results.
+
+    'currencies_from' and 'currencies_to' can be either a single currency code
+    or a sequence with a currency code for each amount. Rates are read once
+    for each pair of currencies and the results are rounded exactly as
+    `base_convert_money` does. Money instances are returned unless
+    'as_decimal' is True.
+
+    'at' can be a datetime, or a sequence with a datetime for each amount,
+    to convert using the rates valid at that moment.
+    """
+    if at is not None:
+        return _convert_money_many_at(amounts, currencies_from, currencies_to, as_decimal, at, source)
+
+    rates = get_cached_rates(source)
+
+    if isinstance(currencies_from, six.string_types):
+        currencies_from = itertools.repeat(currencies_from)
+    if isinstance(currencies_to, six.string_types):
+        currencies_to = itertools.repeat(currencies_to)
+
+    converters = {}
+    results = []
+    for amount, currency_from, currency_to in zip(amounts, currencies_from, currencies_to):
+        pair = (currency_from, currency_to)
+        try:
+            converter = converters[pair]
+        except KeyError:
+            converter = converters[pair] = get_converter(rates, currency_from, currency_to)
+
+        new_amount = converter(amount)
+        results.append(new_amount if as_decimal else moneyed.Money(new_amount, currency_to))
+
+    return results
+
+
+def iter_convert(rows, currency_to, key=None, chunk_size=1000, as_decimal=True, source=None):
+    """
+    Lazily convert 'rows' to 'currency_to' and yield a `(row, converted)`
+    pair for each of them.
+
+    'key' returns the `(amount, currency_from)` pair of a row; by default
+    rows are such pairs. Rows are read and converted 'chunk_size' at a time,
+    so that memory does not grow with the number of rows, and all of them
+    are converted with the rates read when the first row is requested.
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be positive, got %r" % chunk_size)
+    return _iter_convert(rows, currency_to, key, chunk_size, as_decimal, source)
+
+
+def _iter_convert(rows, currency_to, key, chunk_size, as_decimal, source):
+    rates = get_cached_rates(source)
+    converters = {}
+    rows = iter(rows)
+
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+
+        with measure('convert_many'):
+            results = []
+            for row in chunk:
+                amount, currency_from = row if key is None else key(row)
+                try:
+                    converter = converters[currency_from]
+                except KeyError:
+                    converter = converters[currency_from] = get_converter(rates, currency_from, currency_to)
+
+                new_amount = converter(amount)
+                results.append((row, new_amount if as_decimal else moneyed.Money(new_amount, currency_to)))
+
+        for result in results:
+            yield result
+
+
+@instrumented('convert_many')
+def convert_minor_units_many(amounts, currency_from, currency_to, source=None):
+    """
+    Convert the integer 'amounts' of minor units (e.g. cents) of
+    'currency_from' and return a list of amounts in minor units of
+    'currency_to'.
+
+    The conversion uses integer arithmetic on the rates scaled to 6 decimal
+    places, and gives the results of `base_convert_money` on the amounts in
+    major units.
+    """
+    return get_cached_rates(source).convert_minor_units_many(amounts, currency_from, currency_to)
+
+
+def base_convert_minor_units(amount, currency_from, currency_to, source=None):
+    """
+    Convert the integer 'amount' of minor units of 'currency_from' into
+    minor units of 'currency_to' with integer arithmetic
+    """
+    return get_cached_rates(source).convert_minor_units(amount, currency_from, currency_to)
+
+
+def _convert_money_many_at(amounts, currencies_from, currencies_to, as_decimal, at, source):
+    if isinstance(at, datetime.datetime):
+        dates = itertools.repeat(at)
+        history = get_rate_history(at, at, source=source)
+    else:
+        dates = list(at)
+        history = get_rate_history(min(dates), max(dates), source=source) if dates else None
+
+    if isinstance(currencies_from, six.string_types):
+        currencies_from = itertools.repeat(currencies_from)
+    if isinstance(currencies_to, six.string_types):
+        currencies_to = itertools.repeat(currencies_to)
+
+    results = []
+    for amount, currency_from, currency_to, date in zip(amounts, currencies_from, currencies_to, dates):
+        rate_from, rate_to = history.at(date).get_pair_rates(currency_from, currency_to)
+        new_amount = convert_amount(amount, rate_from, rate_to, currency_to)
+        results.append(new_amount if as_decimal else moneyed.Money(new_amount, currency_to))
+
+    return results
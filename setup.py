@@ -47,7 +47,7 @@ setup(
     author_email='synasius@gmail.com',
     url='https://github.com/evonove/django-money-rates',
     license="BSD",
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests', 'tests.*', 'benchmarks']),
     include_package_data=True,
     test_suite='runtests',
     install_requires=[
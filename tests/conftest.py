@@ -0,0 +1,27 @@
+from __future__ import unicode_literals
+
+import sys
+
+import pytest
+
+from django.core.cache import cache
+
+from djmoney_rates.cache import rate_cache
+
+
+# The asynchronous API uses syntax not available on older Pythons
+if sys.version_info < (3, 7):
+    collect_ignore = ["test_async_utils.py"]
+
+
+@pytest.fixture(autouse=True)
+def clear_rate_cache():
+    """
+    The database is flushed between tests without sending any signal,
+    so the rates cached by a test must not leak into the next one.
+    """
+    rate_cache.invalidate()
+    cache.clear()
+    yield
+    rate_cache.invalidate()
+    cache.clear()
@@ -0,0 +1,8 @@
+from __future__ import unicode_literals
+
+from django.db import models
+
+
+class Invoice(models.Model):
+    amount = models.DecimalField(max_digits=20, decimal_places=2)
+    currency = models.CharField(max_length=3)
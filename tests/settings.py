@@ -14,6 +14,7 @@ INSTALLED_APPS = [
     "django.contrib.contenttypes",
     "django.contrib.sites",
     "djmoney_rates",
+    "tests",
 ]
 
 SECRET_KEY = "1234567890evonove"
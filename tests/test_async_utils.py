@@ -0,0 +1,72 @@
+from __future__ import unicode_literals
+
+import asyncio
+from decimal import Decimal
+
+import pytest
+
+from djmoney_rates import async_utils
+from djmoney_rates.async_utils import abase_convert_money, aconvert_money, aget_rate
+from djmoney_rates.backends import BaseRateBackend
+from djmoney_rates.exceptions import CurrencyConversionException
+from djmoney_rates.settings import money_rates_settings
+from djmoney_rates.utils import rates_snapshot
+
+import moneyed
+
+
+class RateBackend(BaseRateBackend):
+    source_name = "fake-backend"
+    base_currency = "USD"
+
+    def get_rates(self):
+        return {"PLN": 3.07, "EUR": 0.74}
+
+
+@pytest.fixture
+def set_up():
+    money_rates_settings.DEFAULT_BACKEND = RateBackend
+    money_rates_settings.RATE_CACHE_ENABLED = True
+    money_rates_settings.RATE_CACHE_CHECK_INTERVAL = 60
+    RateBackend().update_rates()
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_conversion(set_up):
+    assert Decimal("2.41") == run(abase_convert_money(10, "PLN", "EUR"))
+    assert moneyed.Money(Decimal("0.74"), "EUR") == run(aconvert_money(1, "USD", "EUR"))
+    assert Decimal("3.07") == run(aget_rate("PLN"))
+
+
+@pytest.mark.django_db(transaction=True)
+def test_cached_rates_are_used_without_threads(set_up, mocker):
+    run(abase_convert_money(10, "PLN", "EUR"))
+
+    dispatch = mocker.patch.object(async_utils, "sync_to_async")
+    assert Decimal("2.41") == run(abase_convert_money(10, "PLN", "EUR"))
+    assert not dispatch.called
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_conversion_in_snapshot(set_up):
+    async def convert():
+        with rates_snapshot():
+            return await abase_convert_money(10, "PLN", "EUR"), await abase_convert_money(1, "USD", "PLN")
+
+    assert (Decimal("2.41"), Decimal("3.07")) == run(convert())
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_conversion_fail_when_currency_does_not_exist(set_up):
+    with pytest.raises(CurrencyConversionException) as cm:
+        run(abase_convert_money(10, "JPY", "EUR"))
+
+    assert "Rate for JPY in fake-backend do not exists" in str(cm.value)
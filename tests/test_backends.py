@@ -1,15 +1,20 @@
 from __future__ import unicode_literals
 
+import threading
 from decimal import Decimal
 import pytest
 
 from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from mock import patch
 
-from djmoney_rates.backends import BaseRateBackend, RateBackendError, OpenExchangeBackend
+from djmoney_rates.backends import BaseRateBackend, RateBackendError, OpenExchangeBackend, fetch_rates
+from djmoney_rates.http import HTTPResponse
 from djmoney_rates.models import Rate, RateSource
 from djmoney_rates.settings import money_rates_settings
+from djmoney_rates.signals import rates_updated
 
 
 @pytest.fixture
@@ -20,7 +25,7 @@ def custom_data():
         "rates": {"AED": 3.672626, "AFN": 48.3775, "ALL": 110.223333, "AMD": 409.604993,
         "YER": 215.035559, "ZAR": 8.416205, "ZMK": 4954.411262, "ZWL": 322.355011}}""",
         b"""{"disclaimer": "Exchange rates provided by [...]",
-        "license": "Data collected and blended [...]", "timestamp": 1319730758, "base": "USD",
+        "license": "Data collected and blended [...]", "timestamp": 1319734358, "base": "USD",
         "rates": {"AED": 4.672626, "AFN": 48.3775, "ALL": 110.223333, "AMD": 409.604993,
         "YER": 215.035559, "ZAR": 8.416205, "ZMK": 4954.411262, "ZWL": 322.355011}}"""
     ]
@@ -79,10 +84,8 @@ def test_url_is_correct(set_up):
 @pytest.mark.django_db(transaction=True)
 def test_rates_are_saved(set_up, custom_data, mocker):
     backend = OpenExchangeBackend()
-    urlopen_mock = mocker.patch("djmoney_rates.backends.urlopen")
-
-    instance = urlopen_mock.return_value
-    instance.read.return_value = custom_data[0]
+    request_mock = mocker.patch("djmoney_rates.backends.http_request")
+    request_mock.return_value = HTTPResponse(200, {}, custom_data[0])
     backend.update_rates()
 
     assert 8 == Rate.objects.filter(source__name=backend.get_source_name()).count()
@@ -90,18 +93,16 @@ def test_rates_are_saved(set_up, custom_data, mocker):
 @pytest.mark.django_db(transaction=True)
 def test_rates_are_updated(set_up, custom_data, mocker):
     backend = OpenExchangeBackend()
-    urlopen_mock = mocker.patch("djmoney_rates.backends.urlopen")
-
-    instance = urlopen_mock.return_value
-    instance.read.return_value = custom_data[0]
+    request_mock = mocker.patch("djmoney_rates.backends.http_request")
+    request_mock.return_value = HTTPResponse(200, {}, custom_data[0])
     backend.update_rates()
 
     first_update = RateSource.objects.get(name=backend.get_source_name()).last_update
     assert 8 == Rate.objects.filter(source__name=backend.get_source_name()).count()
     assert Decimal("3.672626") == Rate.objects.get(currency="AED").value
 
-    # change return value for mocked urlopen read call
-    instance.read.return_value = custom_data[1]
+    # change return value for mocked request
+    request_mock.return_value = HTTPResponse(200, {}, custom_data[1])
 
     # call update rates again
     backend.update_rates()
@@ -111,3 +112,132 @@ def test_rates_are_updated(set_up, custom_data, mocker):
     assert 8 == Rate.objects.filter(source__name=backend.get_source_name()).count()
     assert last_update > first_update
     assert Decimal("4.672626") == Rate.objects.get(currency="AED").value
+
+@pytest.mark.django_db(transaction=True)
+def test_update_rates_reports_counters():
+    class RateBackend(BaseRateBackend):
+        source_name = "a source"
+        base_currency = "EUR"
+        rates = {"EUR": 1, "USD": 0.2222, "PLN": 0.3333}
+
+        def get_rates(self):
+            return self.rates
+
+    backend = RateBackend()
+    assert (3, 0, 0, 0) == backend.update_rates()[:4]
+
+    backend.rates = {"EUR": 1, "USD": 0.2223, "PLN": 0.3333, "GBP": 0.9}
+    result = backend.update_rates()
+
+    assert 1 == result.created
+    assert 1 == result.updated
+    assert 2 == result.unchanged
+    assert Decimal("0.2223") == Rate.objects.get(currency="USD").value
+
+@pytest.mark.django_db(transaction=True)
+def test_update_rates_writes_and_sends_the_difference():
+    class RateBackend(BaseRateBackend):
+        source_name = "a source"
+        base_currency = "EUR"
+        rates = {"EUR": 1, "USD": 1.2, "PLN": 4.3, "GBP": 0.9}
+
+        def get_rates(self):
+            return self.rates
+
+    received = []
+
+    def receiver(sender, source, changes, **kwargs):
+        received.append(changes)
+
+    backend = RateBackend()
+    backend.update_rates()
+
+    rates_updated.connect(receiver)
+    money_rates_settings.RATE_CHANGE_EPSILON = 0.001
+    try:
+        backend.rates = {"EUR": 1, "USD": 1.2005, "PLN": 4.4, "JPY": 130}
+        result = backend.update_rates()
+    finally:
+        money_rates_settings.RATE_CHANGE_EPSILON = 0
+        rates_updated.disconnect(receiver)
+
+    assert (1, 1, 2, 1) == result[:4]
+    assert [result.changes] == received
+    assert {"JPY": Decimal(130)} == result.changes.created
+    assert {"PLN": (Decimal("4.3"), Decimal("4.4"))} == result.changes.updated
+    assert {"GBP": Decimal("0.9")} == result.changes.removed
+
+    rates = dict(Rate.objects.filter(source__name="a source").values_list("currency", "value"))
+    assert {"EUR": 1, "USD": Decimal("1.2"), "PLN": Decimal("4.4"), "JPY": 130} == rates
+
+@pytest.mark.django_db(transaction=True)
+def test_update_rates_query_count_does_not_depend_on_currencies():
+    class RateBackend(BaseRateBackend):
+        source_name = "a source"
+        base_currency = "EUR"
+        rates = {}
+
+        def get_rates(self):
+            return self.rates
+
+    backend = RateBackend()
+    backend.rates = dict(("C%02d" % i, i) for i in range(50))
+    backend.update_rates()
+
+    backend.rates = dict(("C%02d" % i, i + 1) for i in range(200))
+    with CaptureQueriesContext(connection) as ctx:
+        backend.update_rates()
+    updated_queries = len(ctx.captured_queries)
+
+    with CaptureQueriesContext(connection) as ctx:
+        assert (0, 0, 200, 0) == backend.update_rates()[:4]
+
+    assert updated_queries < 15
+    # nothing but the source is written when rates did not change
+    assert not [q for q in ctx.captured_queries if '"djmoney_rates_rate"' in q['sql'] and 'SELECT' not in q['sql']]
+    assert 200 == Rate.objects.filter(source__name="a source").count()
+
+@pytest.mark.django_db(transaction=True)
+def test_unchanged_timestamp_skips_update(set_up, custom_data, mocker):
+    backend = OpenExchangeBackend()
+    request_mock = mocker.patch("djmoney_rates.backends.http_request")
+    request_mock.return_value = HTTPResponse(200, {}, custom_data[0])
+    backend.update_rates()
+    first_update = RateSource.objects.get(name=backend.get_source_name()).last_update
+
+    assert backend.update_rates() is None
+    assert first_update == RateSource.objects.get(name=backend.get_source_name()).last_update
+
+@pytest.mark.django_db(transaction=True)
+def test_validators_are_sent_and_not_modified_skips_update(set_up, custom_data, mocker):
+    backend = OpenExchangeBackend()
+    request_mock = mocker.patch("djmoney_rates.backends.http_request")
+    request_mock.return_value = HTTPResponse(
+        200, {"etag": '"abc"', "last-modified": "Thu, 27 Oct 2011 16:12:38 GMT"}, custom_data[0])
+    backend.update_rates()
+
+    source = RateSource.objects.get(name=backend.get_source_name())
+    assert '"abc"' == source.http_etag
+    assert 2011 == source.rates_timestamp.year
+
+    request_mock.return_value = HTTPResponse(304, {}, b"")
+    with CaptureQueriesContext(connection) as ctx:
+        assert backend.update_rates() is None
+
+    assert 1 == len(ctx.captured_queries)
+    headers = request_mock.call_args[1]["headers"]
+    assert '"abc"' == headers["If-None-Match"]
+    assert "Thu, 27 Oct 2011 16:12:38 GMT" == headers["If-Modified-Since"]
+
+@pytest.mark.django_db(transaction=True)
+def test_fetch_threads_close_their_connections(set_up, custom_data, mocker):
+    request_mock = mocker.patch("djmoney_rates.backends.http_request")
+    request_mock.return_value = HTTPResponse(200, {}, custom_data[0])
+    connections_mock = mocker.patch("djmoney_rates.backends.connections")
+    closed_by = []
+    connections_mock.close_all.side_effect = lambda: closed_by.append(threading.current_thread())
+
+    [(rates, error)] = fetch_rates([OpenExchangeBackend()])
+
+    assert error is None and "AED" in rates
+    assert 1 == len(closed_by) and threading.current_thread() is not closed_by[0]
@@ -0,0 +1,28 @@
+from __future__ import unicode_literals
+
+import pytest
+
+from benchmarks import run
+
+
+@pytest.mark.django_db(transaction=True)
+def test_conversion_benchmark_in_steady_state():
+    results = run.bench_conversion(iterations=100, size=20)
+
+    assert 0 == results["queries_per_conversion"]
+    assert 2 == results["cold_queries"]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_update_rates_benchmark_queries_do_not_grow_with_currencies():
+    small = run.bench_update_rates(10)
+    large = run.bench_update_rates(300)
+
+    assert small["unchanged_queries"] == large["unchanged_queries"]
+    assert large["create_queries"] - small["create_queries"] <= 6
+
+
+def test_compare_reports_relative_change():
+    rows = run.compare({"a": {"ms": 15.0, "queries": 1}}, {"a": {"ms": 10.0, "queries": 0}, "b": {"ms": 1}})
+
+    assert [("a", "ms", 10.0, 15.0, 0.5), ("a", "queries", 0, 1, float("inf"))] == rows
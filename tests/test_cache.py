@@ -0,0 +1,353 @@
+from __future__ import unicode_literals
+
+import threading
+from decimal import Decimal
+
+import pytest
+
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from djmoney_rates.backends import BaseRateBackend
+from djmoney_rates.cache import rate_cache
+from djmoney_rates.exceptions import CurrencyConversionException
+from djmoney_rates.middleware import RatesSnapshotMiddleware
+from djmoney_rates.models import Rate, RateSource
+from djmoney_rates.settings import money_rates_settings
+from djmoney_rates.utils import base_convert_money, get_rate_source, rates_snapshot, use_rate_source
+
+
+class RateBackend(BaseRateBackend):
+    source_name = "fake-backend"
+    base_currency = "USD"
+
+    def get_rates(self):
+        return {"USD": 1, "PLN": 3.07, "EUR": 0.74}
+
+
+@pytest.fixture
+def set_up():
+    money_rates_settings.DEFAULT_BACKEND = RateBackend
+    money_rates_settings.RATE_CACHE_ENABLED = True
+    money_rates_settings.RATE_CACHE_CHECK_INTERVAL = 60
+    RateBackend().update_rates()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_rates_of_a_source_are_loaded_at_once(set_up):
+    with CaptureQueriesContext(connection) as ctx:
+        rates = rate_cache.get("fake-backend")
+
+    assert 2 == len(ctx.captured_queries)
+    assert "USD" == rates.base_currency
+    assert Decimal("3.07") == rates.get_rate("PLN")
+
+
+@pytest.mark.django_db(transaction=True)
+def test_conversion_does_not_query_in_steady_state(set_up):
+    base_convert_money(10, "PLN", "EUR")
+
+    with CaptureQueriesContext(connection) as ctx:
+        amount = base_convert_money(10, "PLN", "EUR")
+
+    assert 0 == len(ctx.captured_queries)
+    assert Decimal("2.41") == amount
+
+
+@pytest.mark.django_db(transaction=True)
+def test_version_is_checked_when_interval_is_zero(set_up):
+    money_rates_settings.RATE_CACHE_CHECK_INTERVAL = 0
+    base_convert_money(10, "PLN", "EUR")
+
+    with CaptureQueriesContext(connection) as ctx:
+        base_convert_money(10, "PLN", "EUR")
+
+    assert 1 == len(ctx.captured_queries)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_cache_is_invalidated_by_update_rates(set_up):
+    assert Decimal("2.41") == base_convert_money(10, "PLN", "EUR")
+
+    class UpdatedBackend(RateBackend):
+        def get_rates(self):
+            return {"USD": 1, "PLN": 3.07, "EUR": 0.9}
+
+    UpdatedBackend().update_rates()
+
+    assert Decimal("2.93") == base_convert_money(10, "PLN", "EUR")
+
+
+@pytest.mark.django_db(transaction=True)
+def test_cache_is_invalidated_by_rate_change(set_up):
+    base_convert_money(10, "PLN", "EUR")
+    Rate.objects.filter(currency="EUR").get().delete()
+
+    with pytest.raises(CurrencyConversionException):
+        base_convert_money(10, "PLN", "EUR")
+
+
+@pytest.mark.django_db(transaction=True)
+def test_changes_from_other_processes_are_detected(set_up):
+    money_rates_settings.RATE_CACHE_CHECK_INTERVAL = 0
+    base_convert_money(10, "PLN", "EUR")
+
+    # queryset updates do not send any signal, like a refresh run elsewhere
+    Rate.objects.filter(currency="EUR").update(value=Decimal("0.9"))
+    RateSource.objects.filter(name="fake-backend").update(
+        last_update=RateSource.objects.get().last_update.replace(year=2100))
+
+    assert Decimal("2.93") == base_convert_money(10, "PLN", "EUR")
+
+
+@pytest.mark.django_db(transaction=True)
+def test_cache_can_be_disabled(set_up):
+    money_rates_settings.RATE_CACHE_ENABLED = False
+    base_convert_money(10, "PLN", "EUR")
+
+    with CaptureQueriesContext(connection) as ctx:
+        base_convert_money(10, "PLN", "EUR")
+
+    assert 2 == len(ctx.captured_queries)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_cross_rates_give_the_same_results(set_up):
+    amounts = [10, 10.0, Decimal("0.015"), Decimal("123456.789"), 0.1, Decimal("-3.3")]
+    pairs = [("PLN", "EUR"), ("EUR", "PLN"), ("USD", "EUR"), ("EUR", "USD"), ("PLN", "PLN")]
+    expected = [base_convert_money(amount, *pair) for amount in amounts for pair in pairs]
+
+    money_rates_settings.CROSS_RATES_ENABLED = True
+    try:
+        assert expected == [base_convert_money(amount, *pair) for amount in amounts for pair in pairs]
+    finally:
+        money_rates_settings.CROSS_RATES_ENABLED = False
+
+
+@pytest.mark.django_db(transaction=True)
+def test_cross_rates_are_bounded(set_up):
+    money_rates_settings.CROSS_RATES_MAX_PAIRS = 2
+    try:
+        rates = rate_cache.get("fake-backend")
+        rates.get_cross_rate("PLN", "EUR")
+        rates.get_cross_rate("USD", "EUR")
+        rates.get_cross_rate("PLN", "EUR")
+        assert Decimal("3.07") == rates.get_cross_rate("USD", "PLN")
+
+        assert [("PLN", "EUR"), ("USD", "PLN")] == list(rates._cross_rates)
+    finally:
+        money_rates_settings.CROSS_RATES_MAX_PAIRS = 1024
+
+
+@pytest.fixture
+def shared_cache(set_up):
+    money_rates_settings.SHARED_CACHE_ALIAS = "default"
+    money_rates_settings.SHARED_CACHE_FALLBACK = True
+    yield
+    money_rates_settings.SHARED_CACHE_ALIAS = None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_update_rates_publishes_to_shared_cache(shared_cache):
+    RateBackend().update_rates()
+    # other processes start with an empty local cache
+    rate_cache.invalidate()
+
+    with CaptureQueriesContext(connection) as ctx:
+        amount = base_convert_money(10, "PLN", "EUR")
+
+    assert 0 == len(ctx.captured_queries)
+    assert Decimal("2.41") == amount
+
+
+@pytest.mark.django_db(transaction=True)
+def test_shared_cache_is_filled_from_database(shared_cache):
+    assert Decimal("2.41") == base_convert_money(10, "PLN", "EUR")
+
+    rate_cache.invalidate()
+    with CaptureQueriesContext(connection) as ctx:
+        base_convert_money(10, "PLN", "EUR")
+
+    assert 0 == len(ctx.captured_queries)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_shared_cache_is_invalidated_by_rate_change(shared_cache):
+    RateBackend().update_rates()
+    Rate.objects.filter(currency="EUR").get().delete()
+    rate_cache.invalidate()
+
+    with pytest.raises(CurrencyConversionException) as cm:
+        base_convert_money(10, "PLN", "EUR")
+
+    assert "Rate for EUR in fake-backend do not exists" in str(cm.value)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_shared_cache_without_fallback(shared_cache):
+    money_rates_settings.SHARED_CACHE_FALLBACK = False
+
+    with pytest.raises(CurrencyConversionException) as cm:
+        base_convert_money(10, "PLN", "EUR")
+
+    assert "Rates for fake-backend source are not available in the shared cache" in str(cm.value)
+
+    RateBackend().update_rates()
+    assert Decimal("2.41") == base_convert_money(10, "PLN", "EUR")
+
+
+class UpdatedBackend(RateBackend):
+    def get_rates(self):
+        return {"USD": 1, "PLN": 3.07, "EUR": 0.9}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_snapshot_pins_rates(set_up):
+    with rates_snapshot():
+        assert Decimal("2.41") == base_convert_money(10, "PLN", "EUR")
+
+        UpdatedBackend().update_rates()
+        with CaptureQueriesContext(connection) as ctx:
+            assert Decimal("2.41") == base_convert_money(10, "PLN", "EUR")
+            with rates_snapshot():
+                assert Decimal("2.41") == base_convert_money(10, "PLN", "EUR")
+
+        assert 0 == len(ctx.captured_queries)
+
+    assert Decimal("2.93") == base_convert_money(10, "PLN", "EUR")
+
+
+@pytest.mark.django_db(transaction=True)
+def test_snapshot_is_local_to_the_thread(set_up):
+    results = []
+
+    def convert():
+        results.append(base_convert_money(10, "PLN", "EUR"))
+        connection.close()
+
+    with rates_snapshot():
+        base_convert_money(10, "PLN", "EUR")
+        UpdatedBackend().update_rates()
+
+        thread = threading.Thread(target=convert)
+        thread.start()
+        thread.join()
+
+    assert [Decimal("2.93")] == results
+
+
+@pytest.mark.django_db(transaction=True)
+def test_snapshot_middleware(set_up):
+    def view(request):
+        amount = base_convert_money(10, "PLN", "EUR")
+        UpdatedBackend().update_rates()
+        return HttpResponse("%s %s" % (amount, base_convert_money(10, "PLN", "EUR")))
+
+    response = RatesSnapshotMiddleware(view)(RequestFactory().get("/"))
+
+    assert b"2.41 2.41" == response.content
+    assert Decimal("2.93") == base_convert_money(10, "PLN", "EUR")
+
+
+class SecondaryBackend(BaseRateBackend):
+    source_name = "secondary-backend"
+    base_currency = "EUR"
+
+    def get_rates(self):
+        return {"EUR": 1, "USD": 1.25, "GBP": 0.8, "PLN": 5}
+
+
+@pytest.fixture
+def multiple_sources(set_up):
+    money_rates_settings.RATE_SOURCES = [RateBackend, SecondaryBackend]
+    SecondaryBackend().update_rates()
+    yield
+    money_rates_settings.RATE_SOURCES = ()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_missing_currencies_are_read_from_the_next_source(multiple_sources):
+    # GBP is only provided by the secondary source: 1 USD = 0.8 / 1.25 GBP
+    assert Decimal("6.40") == base_convert_money(10, "USD", "GBP")
+    # PLN is read from the first source
+    assert Decimal("30.70") == base_convert_money(10, "USD", "PLN")
+    assert Decimal("47.97") == base_convert_money(10, "GBP", "PLN")
+
+    with pytest.raises(CurrencyConversionException):
+        base_convert_money(10, "USD", "JPY")
+
+
+@pytest.mark.django_db(transaction=True)
+def test_merged_rates_are_rebuilt_when_a_source_changes(multiple_sources):
+    base_convert_money(10, "USD", "GBP")
+    merged = rate_cache.get_merged(("fake-backend", "secondary-backend"))
+
+    with CaptureQueriesContext(connection) as ctx:
+        assert Decimal("6.40") == base_convert_money(10, "USD", "GBP")
+    assert 0 == len(ctx.captured_queries)
+    assert merged is rate_cache.get_merged(("fake-backend", "secondary-backend"))
+
+    class UpdatedBackend(SecondaryBackend):
+        def get_rates(self):
+            return {"EUR": 1, "USD": 1.25, "GBP": 1}
+
+    UpdatedBackend().update_rates()
+
+    assert Decimal("8.00") == base_convert_money(10, "USD", "GBP")
+    assert merged is not rate_cache.get_merged(("fake-backend", "secondary-backend"))
+
+
+class TenantBackend(BaseRateBackend):
+    base_currency = "USD"
+
+    def __init__(self, source_name, eur_rate):
+        self.source_name = source_name
+        self.eur_rate = eur_rate
+
+    def get_rates(self):
+        return {"EUR": self.eur_rate}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_source_can_be_selected_per_call_and_per_context(set_up):
+    TenantBackend("tenant-a", 0.5).update_rates()
+    TenantBackend("tenant-b", 2).update_rates()
+
+    assert Decimal("7.40") == base_convert_money(10, "USD", "EUR")
+    assert Decimal("5.00") == base_convert_money(10, "USD", "EUR", source="tenant-a")
+
+    with use_rate_source("tenant-b"):
+        assert Decimal("20.00") == base_convert_money(10, "USD", "EUR")
+        assert Decimal("5.00") == base_convert_money(10, "USD", "EUR", source="tenant-a")
+        assert "tenant-b" == get_rate_source().name
+
+    assert Decimal("7.40") == base_convert_money(10, "USD", "EUR")
+
+    with pytest.raises(CurrencyConversionException):
+        base_convert_money(10, "USD", "EUR", source="tenant-c")
+
+
+@pytest.mark.django_db(transaction=True)
+def test_least_recently_used_sources_are_evicted(set_up):
+    for name in ("tenant-a", "tenant-b", "tenant-c"):
+        TenantBackend(name, 1).update_rates()
+
+    money_rates_settings.RATE_CACHE_MAX_SOURCES = 2
+    try:
+        base_convert_money(10, "USD", "EUR", source="tenant-a")
+        base_convert_money(10, "USD", "EUR", source="tenant-b")
+        base_convert_money(10, "USD", "EUR", source="tenant-a")
+        base_convert_money(10, "USD", "EUR", source="tenant-c")
+
+        with CaptureQueriesContext(connection) as ctx:
+            base_convert_money(10, "USD", "EUR", source="tenant-a")
+            base_convert_money(10, "USD", "EUR", source="tenant-c")
+        assert 0 == len(ctx.captured_queries)
+
+        with CaptureQueriesContext(connection) as ctx:
+            base_convert_money(10, "USD", "EUR", source="tenant-b")
+        assert 2 == len(ctx.captured_queries)
+    finally:
+        money_rates_settings.RATE_CACHE_MAX_SOURCES = 64
@@ -1,12 +1,21 @@
 from __future__ import unicode_literals
 
+import datetime
+import json
+import threading
+import time
+from decimal import Decimal
+
 import pytest
 
 from django.core.management import call_command
 from django.core.management.base import CommandError
+from django.utils.six import StringIO
+from django.utils.six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 
-from djmoney_rates.backends import BaseRateBackend
-from djmoney_rates.models import Rate, RateSource
+from djmoney_rates.backends import BaseRateBackend, JSONFileBackend
+from djmoney_rates.exceptions import RateBackendError
+from djmoney_rates.models import HistoricalRate, Rate, RateSource
 from djmoney_rates.settings import money_rates_settings
 
 class CustomBackend(BaseRateBackend):
@@ -40,3 +49,271 @@ def test_default_backend_used_when_not_specified():
 
     assert 1 == RateSource.objects.filter(name="custom-backend").count()
     assert 2 == Rate.objects.filter(source__name="custom-backend").count()
+
+class OtherBackend(BaseRateBackend):
+    source_name = "other-backend"
+    base_currency = "EUR"
+
+    def get_rates(self):
+        return {"USD": 1.35}
+
+
+class SlowBackend(BaseRateBackend):
+    source_name = "slow-backend"
+    base_currency = "USD"
+    timeout = 0.2
+
+    def get_rates(self):
+        time.sleep(2)
+        return {"EUR": 0.74}
+
+
+@pytest.fixture
+def stub_server():
+    """
+    Serve the latest rates from a local HTTP server
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps({"base": "USD", "rates": {"EUR": 0.74, "PLN": 3.07}}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield "http://127.0.0.1:%s/api/latest.json" % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+@pytest.mark.django_db(transaction=True)
+def test_many_backends_are_updated():
+    call_command("update_rates", "tests.test_commands.CustomBackend", "tests.test_commands.OtherBackend")
+
+    assert 2 == Rate.objects.filter(source__name="custom-backend").count()
+    assert 1 == Rate.objects.filter(source__name="other-backend").count()
+
+@pytest.mark.django_db(transaction=True)
+def test_configured_backends_are_updated():
+    money_rates_settings.RATE_BACKENDS = [CustomBackend, OtherBackend]
+    try:
+        call_command("update_rates")
+    finally:
+        money_rates_settings.RATE_BACKENDS = []
+
+    assert 2 == RateSource.objects.count()
+
+@pytest.mark.django_db(transaction=True)
+def test_slow_backend_does_not_stall_the_others():
+    started_at = time.time()
+    with pytest.raises(CommandError) as exc:
+        call_command("update_rates", "tests.test_commands.SlowBackend", "tests.test_commands.CustomBackend")
+
+    assert time.time() - started_at < 1
+    assert "Timeout retrieving rates for slow-backend" in str(exc.value)
+    assert 2 == Rate.objects.filter(source__name="custom-backend").count()
+    assert not RateSource.objects.filter(name="slow-backend").exists()
+
+@pytest.mark.django_db(transaction=True)
+def test_deadline_limits_all_backends():
+    with pytest.raises(CommandError) as exc:
+        call_command("update_rates", "tests.test_commands.SlowBackend", deadline=0.1)
+
+    assert "after 0.1 seconds" in str(exc.value)
+
+@pytest.mark.django_db(transaction=True)
+def test_openexchange_backend_against_stub_server(stub_server):
+    money_rates_settings.OPENEXCHANGE_URL = stub_server
+    money_rates_settings.OPENEXCHANGE_APP_ID = "fake-app-id"
+
+    out = StringIO()
+    call_command("update_rates", "djmoney_rates.backends.OpenExchangeBackend", stdout=out)
+
+    assert "(2 created, 0 updated, 0 unchanged, 0 removed)" in out.getvalue()
+    assert Decimal("3.07") == Rate.objects.get(source__name="openexchange.org", currency="PLN").value
+
+@pytest.mark.django_db(transaction=True)
+def test_csv_amounts_are_converted(tmpdir):
+    money_rates_settings.DEFAULT_BACKEND = CustomBackend
+    CustomBackend().update_rates()
+
+    input_path = tmpdir.join("invoices.csv")
+    input_path.write("id,amount,currency\n1,10.00,PLN\n2,1,USD\n3,-5.5,EUR\n")
+    output_path = tmpdir.join("converted.csv")
+
+    out = StringIO()
+    call_command("convert_csv", str(input_path), str(output_path), to="EUR", chunk_size=2, stdout=out)
+
+    assert "Converted 3 rows to EUR" in out.getvalue()
+    assert ["id,amount,currency,amount_eur", "1,10.00,PLN,2.41", "2,1,USD,0.74", "3,-5.5,EUR,-5.50"] == \
+        output_path.read().splitlines()
+
+@pytest.mark.django_db(transaction=True)
+def test_csv_conversion_reports_invalid_rows(tmpdir):
+    money_rates_settings.DEFAULT_BACKEND = CustomBackend
+    CustomBackend().update_rates()
+
+    input_path = tmpdir.join("invoices.csv")
+    input_path.write("amount,currency\n10.00,PLN\nten,USD\n")
+
+    with pytest.raises(CommandError) as exc:
+        call_command("convert_csv", str(input_path), str(tmpdir.join("out.csv")), to="EUR")
+    assert "Invalid amount or currency at line 3" in str(exc.value)
+
+    input_path.write("amount,currency\n10.00,JPY\n")
+    with pytest.raises(CommandError) as exc:
+        call_command("convert_csv", str(input_path), str(tmpdir.join("out.csv")), to="EUR")
+    assert "Rate for JPY in custom-backend do not exists" in str(exc.value)
+
+
+def test_csv_conversion_rejects_empty_chunks(tmpdir):
+    input_path = tmpdir.join("invoices.csv")
+    input_path.write("amount,currency\n10.00,PLN\n")
+
+    with pytest.raises(CommandError) as exc:
+        call_command("convert_csv", str(input_path), str(tmpdir.join("out.csv")), to="EUR", chunk_size=0)
+    assert "--chunk-size must be positive" in str(exc.value)
+    assert not tmpdir.join("out.csv").exists()
+
+@pytest.mark.django_db(transaction=True)
+def test_changes_are_listed_when_verbose():
+    call_command("update_rates", "tests.test_commands.CustomBackend")
+
+    out = StringIO()
+    call_command("update_rates", "tests.test_commands.OtherBackend", "tests.test_commands.CustomBackend",
+                 verbosity=2, stdout=out)
+
+    assert "(1 created, 0 updated, 0 unchanged, 0 removed)" in out.getvalue()
+    assert "  + USD 1.350000" in out.getvalue()
+    assert "(0 created, 0 updated, 2 unchanged, 0 removed)" in out.getvalue()
+
+
+class JSONHistoryBackend(JSONFileBackend):
+    source_name = "json-history"
+    base_currency = "USD"
+
+
+class FailingHistoryBackend(BaseRateBackend):
+    source_name = "failing-history"
+    base_currency = "USD"
+
+    def get_historical_rates(self, start, end):
+        date = start
+        while date <= end:
+            if date > datetime.date(2017, 1, 3):
+                raise RateBackendError("No rates for %s" % date)
+            yield date, {"EUR": 0.74}
+            date += datetime.timedelta(days=1)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_history_is_backfilled_in_chunks_from_the_checkpoint(tmpdir):
+    rates_dir = tmpdir.mkdir("rates")
+    for day in range(1, 11):
+        rates_dir.join("2017-01-%02d.jsonl" % day).write(json.dumps(
+            {"date": "2017-01-%02d" % day, "rates": {"EUR": 0.74, "PLN": 3.07}}))
+    checkpoint = str(tmpdir.join("checkpoint.json"))
+
+    out = StringIO()
+    call_command("backfill_rates", "tests.test_commands.JSONHistoryBackend", path=str(rates_dir),
+                 start="2017-01-02", end="2017-01-08", chunk_days=3, workers=2, checkpoint=checkpoint, stdout=out)
+
+    assert "Backfilled 2017-01-08 to 2017-01-08: 2 rates (3/3 chunks," in out.getvalue()
+    assert 'Successfully backfilled 14 rates for "json-history"' in out.getvalue()
+    assert {"source": "json-history", "backfilled": [["2017-01-02", "2017-01-08"]]} == \
+        json.loads(tmpdir.join("checkpoint.json").read())
+
+    out = StringIO()
+    call_command("backfill_rates", "tests.test_commands.JSONHistoryBackend", path=str(rates_dir),
+                 start="2017-01-02", end="2017-01-10", checkpoint=checkpoint, stdout=out)
+
+    assert "Resuming, 1 chunks left" in out.getvalue()
+    assert 'Successfully backfilled 4 rates for "json-history"' in out.getvalue()
+    assert 18 == HistoricalRate.objects.filter(source__name="json-history").count()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_single_file_history_is_read_once(tmpdir, mocker):
+    rates_file = tmpdir.join("history.jsonl")
+    # Newest first, as the ECB publishes its history
+    rates_file.write("\n".join(json.dumps({"date": "2017-01-%02d" % day, "rates": {"EUR": 0.74, "PLN": 3.07}})
+                               for day in range(10, 0, -1)))
+    checkpoint = str(tmpdir.join("checkpoint.json"))
+    parse = mocker.spy(JSONHistoryBackend, "parse")
+
+    out = StringIO()
+    call_command("backfill_rates", "tests.test_commands.JSONHistoryBackend", path=str(rates_file),
+                 start="2017-01-02", end="2017-01-08", chunk_days=3, checkpoint=checkpoint, stdout=out)
+
+    assert 1 == parse.call_count
+    assert "Backfilled 2017-01-08 to 2017-01-08: 2 rates (1/3 chunks," in out.getvalue()
+    assert "Backfilled 2017-01-02 to 2017-01-04: 6 rates (3/3 chunks," in out.getvalue()
+    assert [["2017-01-02", "2017-01-08"]] == json.loads(tmpdir.join("checkpoint.json").read())["backfilled"]
+
+    out = StringIO()
+    call_command("backfill_rates", "tests.test_commands.JSONHistoryBackend", path=str(rates_file),
+                 start="2017-01-01", end="2017-01-10", chunk_days=3, checkpoint=checkpoint, stdout=out)
+
+    assert 2 == parse.call_count
+    assert 'Successfully backfilled 6 rates for "json-history"' in out.getvalue()
+    assert 20 == HistoricalRate.objects.filter(source__name="json-history").count()
+    assert [["2017-01-01", "2017-01-10"]] == json.loads(tmpdir.join("checkpoint.json").read())["backfilled"]
+@pytest.mark.django_db(transaction=True)
+def test_backfill_stops_at_the_failed_chunk(tmpdir):
+    checkpoint = str(tmpdir.join("checkpoint.json"))
+
+    with pytest.raises(CommandError) as exc:
+        call_command("backfill_rates", "tests.test_commands.FailingHistoryBackend", start="2017-01-01",
+                     end="2017-01-06", chunk_days=2, checkpoint=checkpoint, stdout=StringIO())
+
+    assert "Error during backfill from 2017-01-03 to 2017-01-04: No rates for 2017-01-04" in str(exc.value)
+    assert [["2017-01-01", "2017-01-02"]] == json.loads(tmpdir.join("checkpoint.json").read())["backfilled"]
+    # The rates of the failed chunk are not written
+    assert 2 == HistoricalRate.objects.filter(source__name="failing-history").count()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_openexchange_history_is_backfilled_from_stub_server(stub_server):
+    money_rates_settings.OPENEXCHANGE_HISTORICAL_URL = stub_server.replace("latest.json", "historical/")
+    money_rates_settings.OPENEXCHANGE_APP_ID = "fake-app-id"
+    try:
+        out = StringIO()
+        call_command("backfill_rates", "djmoney_rates.backends.OpenExchangeBackend",
+                     start="2017-01-01", end="2017-01-03", stdout=out)
+    finally:
+        money_rates_settings.reload()
+
+    assert 'Successfully backfilled 6 rates for "openexchange.org"' in out.getvalue()
+    dates = HistoricalRate.objects.filter(currency="PLN").values_list("effective_at", flat=True)
+    assert [datetime.date(2017, 1, day) for day in (1, 2, 3)] == sorted(date.date() for date in dates)
+
+
+class OverridingBackend(BaseRateBackend):
+    source_name = "overriding-backend"
+    base_currency = "USD"
+
+    def get_rates(self):
+        return {"EUR": 0.74}
+
+    def update_rates(self):
+        RateSource.objects.create(name="overridden", base_currency="USD")
+        return super(OverridingBackend, self).update_rates()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_overridden_update_rates_is_called():
+    out = StringIO()
+    call_command("update_rates", "tests.test_commands.OverridingBackend", "tests.test_commands.CustomBackend",
+                 stdout=out)
+
+    assert RateSource.objects.filter(name="overridden").exists()
+    assert 1 == Rate.objects.filter(source__name="overriding-backend").count()
+    assert 2 == Rate.objects.filter(source__name="custom-backend").count()
+    assert 2 == out.getvalue().count("Successfully updated rates")
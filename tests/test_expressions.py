@@ -0,0 +1,104 @@
+from __future__ import unicode_literals
+
+from decimal import Decimal
+
+import pytest
+
+from django.db import connection
+from django.db.models import Sum
+from django.test.utils import CaptureQueriesContext
+
+from djmoney_rates.backends import BaseRateBackend
+from djmoney_rates.exceptions import CurrencyConversionException
+from djmoney_rates.expressions import ConvertedAmount
+from djmoney_rates.settings import money_rates_settings
+from djmoney_rates.utils import base_convert_money
+
+from .models import Invoice
+
+
+class RateBackend(BaseRateBackend):
+    source_name = "fake-backend"
+    base_currency = "USD"
+
+    def get_rates(self):
+        return {"PLN": 3.07, "EUR": 0.74, "GBP": 0.61, "JPY": 113.57}
+
+
+@pytest.fixture
+def invoices():
+    money_rates_settings.DEFAULT_BACKEND = RateBackend
+    RateBackend().update_rates()
+
+    amounts = [("10.00", "PLN"), ("1.00", "USD"), ("123.45", "GBP"), ("99.99", "EUR"), ("0.10", "PLN")]
+    return [Invoice.objects.create(amount=Decimal(amount), currency=currency) for amount, currency in amounts]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_annotation_matches_base_convert_money(invoices):
+    converted = Invoice.objects.annotate(eur=ConvertedAmount('amount', 'currency', to='EUR')).order_by('pk')
+
+    assert [base_convert_money(invoice.amount, invoice.currency, "EUR") for invoice in invoices] == \
+        [invoice.eur for invoice in converted]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_annotation_is_rounded_for_the_target_currency(invoices):
+    converted = Invoice.objects.annotate(jpy=ConvertedAmount('amount', 'currency', to='JPY')).order_by('pk')
+
+    assert [base_convert_money(invoice.amount, invoice.currency, "JPY") for invoice in invoices] == \
+        [invoice.jpy for invoice in converted]
+    assert Decimal("114") == converted[1].jpy
+
+
+@pytest.mark.django_db(transaction=True)
+def test_aggregation_runs_in_one_query(invoices):
+    base_convert_money(1, "USD", "EUR")
+
+    with CaptureQueriesContext(connection) as ctx:
+        total = Invoice.objects.aggregate(
+            total=Sum(ConvertedAmount('amount', 'currency', to='PLN', check_currencies=False)))['total']
+
+    assert 1 == len(ctx.captured_queries)
+    expected = sum(base_convert_money(invoice.amount, invoice.currency, "PLN") for invoice in invoices)
+    assert expected == total.quantize(Decimal("1.00"))
+
+
+@pytest.mark.django_db(transaction=True)
+def test_missing_target_rate(invoices):
+    with pytest.raises(CurrencyConversionException):
+        ConvertedAmount('amount', 'currency', to='BRL')
+
+
+@pytest.mark.django_db(transaction=True)
+def test_missing_source_rate(invoices):
+    Invoice.objects.create(amount=Decimal("1000"), currency="BRL")
+
+    with pytest.raises(CurrencyConversionException) as exc:
+        Invoice.objects.aggregate(total=Sum(ConvertedAmount('amount', 'currency', to='EUR')))
+    assert "Rate for BRL in fake-backend do not exists" in str(exc.value)
+
+    with pytest.raises(CurrencyConversionException):
+        list(Invoice.objects.annotate(eur=ConvertedAmount('amount', 'currency', to='EUR')))
+
+    converted = Invoice.objects.exclude(currency="BRL").aggregate(
+        total=Sum(ConvertedAmount('amount', 'currency', to='EUR')))['total']
+    assert converted is not None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_currencies_of_the_filtered_rows_are_checked_on_evaluation(invoices):
+    Invoice.objects.create(amount=Decimal("1000"), currency="BRL")
+    base_convert_money(1, "USD", "EUR")
+
+    with CaptureQueriesContext(connection) as ctx:
+        queryset = Invoice.objects.annotate(eur=ConvertedAmount('amount', 'currency', to='EUR'))
+        filtered = queryset.filter(currency="PLN").order_by('pk')
+    assert 0 == len(ctx.captured_queries)
+
+    assert [base_convert_money(invoice.amount, "PLN", "EUR") for invoice in invoices if invoice.currency == "PLN"] == \
+        [invoice.eur for invoice in filtered]
+    assert 2 == Invoice.objects.annotate(eur=ConvertedAmount('amount', 'currency', to='EUR')).filter(
+        currency="PLN", eur__gt=0).count()
+    with pytest.raises(CurrencyConversionException):
+        list(queryset)
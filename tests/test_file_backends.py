@@ -0,0 +1,156 @@
+from __future__ import unicode_literals
+
+import datetime
+import gzip
+import json
+from decimal import Decimal
+
+import pytest
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+
+from djmoney_rates.backends import CSVFileBackend, ECBXMLFileBackend, JSONFileBackend
+from djmoney_rates.models import HistoricalRate, Rate, RateSource
+
+
+ECB_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<gesmes:Envelope xmlns:gesmes="http://www.gesmes.org/xml/2002-08-01"
+                 xmlns="http://www.ecb.int/vocabulary/2002-08-01/eurofxref">
+    <gesmes:subject>Reference rates</gesmes:subject>
+    <Cube>
+        <Cube time="2017-01-04">
+            <Cube currency="USD" rate="1.0485"/>
+            <Cube currency="JPY" rate="123.18"/>
+        </Cube>
+        <Cube time="2017-01-03">
+            <Cube currency="USD" rate="1.0389"/>
+            <Cube currency="JPY" rate="122.41"/>
+        </Cube>
+    </Cube>
+</gesmes:Envelope>
+"""
+
+
+@pytest.fixture
+def ecb_file(tmpdir):
+    path = tmpdir.join("eurofxref-hist.xml")
+    path.write(ECB_XML)
+    return str(path)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_ecb_backend_saves_the_latest_rates(ecb_file):
+    backend = ECBXMLFileBackend(ecb_file)
+
+    assert (3, 0, 0, 0) == backend.update_rates()[:4]
+    assert Decimal("1.0485") == Rate.objects.get(source__name="ecb", currency="USD").value
+    assert Decimal(1) == Rate.objects.get(source__name="ecb", currency="EUR").value
+
+    source = RateSource.objects.get(name="ecb")
+    assert datetime.datetime(2017, 1, 4, tzinfo=timezone.utc) == source.rates_timestamp
+    assert backend.update_rates() is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_history_is_loaded_in_batches(ecb_file):
+    backend = ECBXMLFileBackend(ecb_file)
+
+    assert 6 == backend.save_history(backend.iter_rates(), batch_size=2)
+    assert 0 == backend.save_history(backend.iter_rates())
+
+    history = HistoricalRate.objects.filter(source__name="ecb", currency="JPY").order_by("effective_at")
+    assert [Decimal("122.41"), Decimal("123.18")] == [rate.value for rate in history]
+    assert datetime.datetime(2017, 1, 3, tzinfo=timezone.utc) == history[0].effective_at
+
+
+def test_large_files_are_memory_mapped(ecb_file, mocker):
+    mocker.patch("djmoney_rates.backends.MMAP_THRESHOLD", 0)
+
+    dates = [date for date, rates in ECBXMLFileBackend(ecb_file).iter_rates()]
+    assert [datetime.date(2017, 1, 4), datetime.date(2017, 1, 3)] == dates
+
+
+def test_csv_backend_reads_both_layouts(tmpdir):
+    wide = tmpdir.join("eurofxref-hist.csv")
+    wide.write("Date,USD,JPY,CYP,\n2017-01-04,1.0485,123.18,N/A,\n2017-01-03,1.0389,122.41,N/A,\n")
+    assert [(datetime.date(2017, 1, 4), {"USD": "1.0485", "JPY": "123.18"}),
+            (datetime.date(2017, 1, 3), {"USD": "1.0389", "JPY": "122.41"})] == \
+        list(CSVFileBackend(str(wide)).iter_rates())
+
+    long = tmpdir.join("rates.csv")
+    long.write("date,currency,rate\n2017-01-03,USD,1.0389\n2017-01-03,JPY,122.41\n2017-01-04,USD,1.0485\n")
+    assert [(datetime.date(2017, 1, 3), {"USD": "1.0389", "JPY": "122.41"}),
+            (datetime.date(2017, 1, 4), {"USD": "1.0485"})] == list(CSVFileBackend(str(long)).iter_rates())
+
+
+@pytest.mark.django_db(transaction=True)
+def test_csv_backend_skips_blank_rows_and_missing_values(tmpdir):
+    long = tmpdir.join("rates.csv")
+    long.write("date,currency,rate\n2017-01-03,USD,1.0389\n\n2017-01-03,CYP,N/A\n,,\n"
+               "2017-01-03,JPY,\n2017-01-04,USD,1.0485\n\n")
+
+    backend = CSVFileBackend(str(long))
+    backend.source_name, backend.base_currency = "csv-files", "EUR"
+    assert [(datetime.date(2017, 1, 3), {"USD": "1.0389"}),
+            (datetime.date(2017, 1, 4), {"USD": "1.0485"})] == list(backend.iter_rates())
+    assert 2 == backend.save_history(backend.iter_rates())
+
+
+@pytest.mark.django_db(transaction=True)
+def test_csv_backend_collects_the_rates_of_a_date_across_the_file(tmpdir):
+    long = tmpdir.join("rates.csv")
+    long.write("date,currency,rate\n2017-01-03,JPY,122.41\n2017-01-04,JPY,123.18\n"
+               "2017-01-03,USD,1.0389\n2017-01-04,USD,1.0485\n")
+
+    backend = CSVFileBackend(str(long))
+    backend.source_name, backend.base_currency = "csv-files", "EUR"
+    assert [(datetime.date(2017, 1, 3), {"USD": "1.0389", "JPY": "122.41"}),
+            (datetime.date(2017, 1, 4), {"USD": "1.0485", "JPY": "123.18"})] == list(backend.iter_rates())
+
+    backend.update_rates()
+    assert {"JPY": Decimal("123.18"), "USD": Decimal("1.0485")} == dict(
+        Rate.objects.filter(source__name="csv-files").values_list("currency", "value"))
+
+
+def test_json_backend_reads_documents_and_json_lines_from_a_directory(tmpdir):
+    tmpdir.join("2017-01-03.json").write(json.dumps(
+        {"timestamp": 1483401600, "base": "USD", "rates": {"EUR": 0.96}}, indent=2))
+    with gzip.open(str(tmpdir.join("2017-01-04.jsonl.gz")), "wb") as f:
+        f.write(b'{"date": "2017-01-04", "rates": {"EUR": 0.95}}\n{"date": "2017-01-05", "rates": {"EUR": 0.94}}\n')
+    tmpdir.join("README.txt").write("not rates")
+
+    backend = JSONFileBackend(str(tmpdir))
+    assert [(datetime.date(2017, 1, 3), {"EUR": 0.96}),
+            (datetime.date(2017, 1, 4), {"EUR": 0.95}),
+            (datetime.date(2017, 1, 5), {"EUR": 0.94})] == list(backend.iter_rates())
+
+
+@pytest.mark.django_db(transaction=True)
+def test_latest_rates_are_read_from_the_last_file(tmpdir):
+    class RateBackend(JSONFileBackend):
+        source_name = "json-files"
+        base_currency = "USD"
+
+    tmpdir.join("2017-01-03.jsonl").write('{"date": "2017-01-03", "rates": {"EUR": 0.96}}\n')
+    tmpdir.join("2017-01-04.jsonl").write('{"date": "2017-01-04", "rates": {"EUR": 0.95}}\n')
+
+    RateBackend(str(tmpdir)).update_rates()
+    assert Decimal("0.95") == Rate.objects.get(source__name="json-files", currency="EUR").value
+
+
+@pytest.mark.django_db(transaction=True)
+def test_latest_rates_are_the_dated_ones(tmpdir):
+    class RateBackend(JSONFileBackend):
+        source_name = "json-files"
+        base_currency = "USD"
+
+    tmpdir.join("rates.jsonl").write('{"rates": {"EUR": 0.97}}\n{"date": "2017-01-04", "rates": {"EUR": 0.95}}\n'
+                                     '{"date": "2017-01-03", "rates": {"EUR": 0.96}}\n')
+
+    assert {"EUR": 0.95} == RateBackend(str(tmpdir)).get_rates()
+
+
+def test_path_is_required():
+    with pytest.raises(ImproperlyConfigured):
+        ECBXMLFileBackend()
@@ -0,0 +1,128 @@
+from __future__ import unicode_literals
+
+from datetime import timedelta
+from decimal import Decimal
+
+import pytest
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from djmoney_rates.backends import BaseRateBackend
+from djmoney_rates.exceptions import CurrencyConversionException
+from djmoney_rates.models import HistoricalRate, RateSource
+from djmoney_rates.settings import money_rates_settings
+from djmoney_rates.utils import base_convert_money, convert_money, convert_money_many
+
+import moneyed
+
+
+class RateBackend(BaseRateBackend):
+    source_name = "fake-backend"
+    base_currency = "USD"
+    rates = {}
+
+    def get_rates(self):
+        return self.rates
+
+
+@pytest.fixture
+def history():
+    """
+    Create three days of history with EUR changing every day
+    """
+    money_rates_settings.DEFAULT_BACKEND = RateBackend
+    money_rates_settings.RATE_HISTORY_ENABLED = True
+
+    backend = RateBackend()
+    for value in ("0.70", "0.80", "0.90"):
+        backend.rates = {"USD": 1, "PLN": 3.07, "EUR": Decimal(value)}
+        backend.update_rates()
+
+    source = RateSource.objects.get(name="fake-backend")
+    start = timezone.now().replace(microsecond=0) - timedelta(days=3)
+    for day, value in enumerate(("0.70", "0.80", "0.90")):
+        HistoricalRate.objects.filter(source=source, value=Decimal(value)).update(
+            effective_at=start + timedelta(days=day))
+    HistoricalRate.objects.filter(source=source, currency__in=["USD", "PLN"]).update(effective_at=start)
+
+    return start
+
+
+@pytest.mark.django_db(transaction=True)
+def test_update_rates_records_changes_only(history):
+    assert 3 == HistoricalRate.objects.filter(currency="EUR").count()
+    assert 1 == HistoricalRate.objects.filter(currency="PLN").count()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_conversion_at_a_point_in_time(history):
+    assert Decimal("0.70") == base_convert_money(1, "USD", "EUR", at=history)
+    assert Decimal("0.70") == base_convert_money(1, "USD", "EUR", at=history + timedelta(hours=23))
+    assert Decimal("0.80") == base_convert_money(1, "USD", "EUR", at=history + timedelta(days=1))
+    assert moneyed.Money(Decimal("0.90"), "EUR") == convert_money(1, "USD", "EUR", at=timezone.now())
+    assert Decimal("0.90") == base_convert_money(1, "USD", "EUR")
+
+
+@pytest.mark.django_db(transaction=True)
+def test_conversion_at_a_point_in_time_uses_one_query(history):
+    base_convert_money(1, "USD", "EUR")
+
+    with CaptureQueriesContext(connection) as ctx:
+        assert Decimal("2.61") == base_convert_money(10, "PLN", "EUR", at=history + timedelta(days=1))
+
+    assert 1 == len(ctx.captured_queries)
+    # A LIMIT 1 lookup per currency, served by the index
+    assert 2 == ctx.captured_queries[0]["sql"].count("LIMIT 1)")
+
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN QUERY PLAN " + ctx.captured_queries[0]["sql"])
+        plan = " ".join(str(row[-1]) for row in cursor.fetchall())
+    assert "TEMP B-TREE" not in plan
+
+    with CaptureQueriesContext(connection) as ctx:
+        assert Decimal("0.80") == base_convert_money(1, "USD", "EUR", at=history + timedelta(days=1))
+    assert 1 == ctx.captured_queries[0]["sql"].count("LIMIT 1)")
+
+
+@pytest.mark.django_db(transaction=True)
+def test_conversion_fail_before_history(history):
+    with pytest.raises(CurrencyConversionException) as cm:
+        base_convert_money(1, "USD", "EUR", at=history - timedelta(seconds=1))
+
+    assert "Rate for EUR in fake-backend at" in str(cm.value)
+
+    with pytest.raises(CurrencyConversionException) as cm:
+        base_convert_money(1, "GBP", "EUR", at=history)
+
+    assert "Rate for GBP in fake-backend at" in str(cm.value)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_batch_conversion_at_points_in_time(history):
+    dates = [history + timedelta(hours=hours) for hours in range(0, 72, 6)] * 100
+    expected = [base_convert_money(10, "PLN", "EUR", at=date) for date in dates[:12]] * 100
+
+    with CaptureQueriesContext(connection) as ctx:
+        amounts = convert_money_many([10] * len(dates), "PLN", "EUR", as_decimal=True, at=dates)
+
+    assert expected == amounts
+    assert len(ctx.captured_queries) <= 3
+    assert [Decimal("2.28"), Decimal("2.61"), Decimal("2.93")] == sorted(set(amounts))
+
+
+@pytest.mark.django_db(transaction=True)
+def test_history_of_written_currencies_is_not_read(history):
+    backend = RateBackend()
+    backend.rates = {"USD": 1, "PLN": 3.07, "EUR": Decimal("0.95")}
+
+    with CaptureQueriesContext(connection) as ctx:
+        backend.update_rates()
+
+    history_queries = [query["sql"] for query in ctx.captured_queries
+                       if "SELECT DISTINCT" in query["sql"] and "historicalrate" in query["sql"]]
+    assert 1 == len(history_queries)
+    assert "'PLN'" in history_queries[0] and "'EUR'" not in history_queries[0]
+    assert 4 == HistoricalRate.objects.filter(currency="EUR").count()
+    assert 1 == HistoricalRate.objects.filter(currency="PLN").count()
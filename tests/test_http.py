@@ -0,0 +1,67 @@
+from __future__ import unicode_literals
+
+import threading
+
+import pytest
+
+from django.utils.six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from djmoney_rates.http import ConnectionPool
+
+
+@pytest.fixture
+def server():
+    clients = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            clients.append(self.client_address)
+            if self.path == "/old":
+                self.send_response(301)
+                self.send_header("Location", "/new")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            body = self.path.encode("utf-8")
+            self.send_response(200)
+            self.send_header("ETag", '"etag"')
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    httpd.clients = clients
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_connections_are_reused(server):
+    pool = ConnectionPool()
+    url = "http://127.0.0.1:%s" % server.server_address[1]
+
+    first = pool.request(url + "/first", timeout=5)
+    second = pool.request(url + "/second?query=1", timeout=5)
+    pool.clear()
+
+    assert (200, b"/first") == (first.status, first.body)
+    assert b"/second?query=1" == second.body
+    assert '"etag"' == second.headers["etag"]
+    assert server.clients[0] == server.clients[1]
+
+
+def test_redirects_are_followed(server):
+    pool = ConnectionPool()
+    response = pool.request("http://127.0.0.1:%s/old" % server.server_address[1], timeout=5)
+    pool.clear()
+
+    assert b"/new" == response.body
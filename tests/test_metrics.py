@@ -0,0 +1,64 @@
+from __future__ import unicode_literals
+
+import pytest
+
+from djmoney_rates.backends import BaseRateBackend
+from djmoney_rates.settings import money_rates_settings
+from djmoney_rates.utils import base_convert_money, convert_money
+
+
+class RateBackend(BaseRateBackend):
+    source_name = "fake-backend"
+    base_currency = "USD"
+
+    def get_rates(self):
+        return {"USD": 1, "PLN": 3.07, "EUR": 0.74}
+
+
+@pytest.fixture
+def events():
+    events = []
+    money_rates_settings.DEFAULT_BACKEND = RateBackend
+    money_rates_settings.RATE_CACHE_CHECK_INTERVAL = 60
+    money_rates_settings.METRICS_CALLBACK = lambda name, **data: events.append((name, data))
+    yield events
+    money_rates_settings.METRICS_CALLBACK = None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_update_rates_metrics(events):
+    RateBackend().update_rates()
+
+    names = [name for name, data in events]
+    assert ["update_rates.fetch", "update_rates.write"] == names
+
+    write = events[1][1]
+    assert "fake-backend" == write["source"]
+    assert 3 == write["created"]
+    assert 0 == write["updated"]
+    assert write["queries"] > 0
+    assert write["duration"] >= 0
+
+
+@pytest.mark.django_db(transaction=True)
+def test_conversion_metrics(events):
+    RateBackend().update_rates()
+    del events[:]
+
+    base_convert_money(10, "PLN", "EUR")
+    convert_money(10, "PLN", "EUR")
+
+    assert ["rate_cache.miss", "convert", "rate_cache.hit", "convert"] == [name for name, data in events]
+    assert 2 == events[1][1]["queries"]
+    assert 0 == events[3][1]["queries"]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_callback_errors_do_not_break_conversions(events):
+    RateBackend().update_rates()
+
+    def callback(name, **data):
+        raise ValueError("broken sink")
+
+    money_rates_settings.METRICS_CALLBACK = callback
+    assert base_convert_money(10, "PLN", "EUR")
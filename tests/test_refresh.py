@@ -0,0 +1,117 @@
+from __future__ import unicode_literals
+
+import datetime
+import threading
+from decimal import Decimal
+
+import pytest
+
+from django.core.cache import cache
+from django.test import override_settings
+from django.utils import timezone
+
+from djmoney_rates.backends import BaseRateBackend
+from djmoney_rates.models import RateSource
+from djmoney_rates.refresh import rate_refresher
+from djmoney_rates.utils import base_convert_money
+
+
+class RefreshBackend(BaseRateBackend):
+    source_name = "refresh-backend"
+    base_currency = "USD"
+    rates = {"USD": 1, "EUR": Decimal("0.74")}
+    calls = 0
+    # Set while the provider is allowed to answer
+    released = threading.Event()
+
+    def get_rates(self):
+        RefreshBackend.calls += 1
+        assert RefreshBackend.released.wait(5)
+        return RefreshBackend.rates
+
+
+REFRESH_SETTINGS = {
+    "DEFAULT_BACKEND": "tests.test_refresh.RefreshBackend",
+    "RATE_REFRESH_ENABLED": True,
+    "RATE_CACHE_CHECK_INTERVAL": 0,
+}
+
+
+@pytest.fixture
+def stale_source():
+    RefreshBackend.rates = {"USD": 1, "EUR": Decimal("0.74")}
+    RefreshBackend.released.set()
+    RefreshBackend().update_rates()
+    RefreshBackend.calls = 0
+    RefreshBackend.released.clear()
+    RefreshBackend.rates = {"USD": 1, "EUR": Decimal("0.80")}
+    RateSource.objects.filter(name="refresh-backend").update(
+        last_update=timezone.now() - datetime.timedelta(hours=2))
+
+    with override_settings(DJANGO_MONEY_RATES=REFRESH_SETTINGS):
+        yield
+        RefreshBackend.released.set()
+        rate_refresher.wait()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_stale_rates_are_served_while_a_single_refresh_runs(stale_source):
+    results = []
+
+    def convert():
+        results.append(base_convert_money(10, "USD", "EUR"))
+
+    threads = [threading.Thread(target=convert) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # The conversions did not wait for the provider
+    assert [Decimal("7.40")] * 8 == results
+    assert 1 == RefreshBackend.calls
+
+    RefreshBackend.released.set()
+    rate_refresher.wait()
+    assert Decimal("8.00") == base_convert_money(10, "USD", "EUR")
+    assert 1 == RefreshBackend.calls
+
+
+@pytest.mark.django_db(transaction=True)
+def test_fresh_rates_are_not_refreshed(stale_source):
+    RateSource.objects.filter(name="refresh-backend").update(last_update=timezone.now())
+
+    base_convert_money(10, "USD", "EUR")
+    assert 0 == RefreshBackend.calls
+
+    with override_settings(DJANGO_MONEY_RATES=dict(REFRESH_SETTINGS, RATE_REFRESH_MAX_AGES={"refresh-backend": 0})):
+        base_convert_money(10, "USD", "EUR")
+        RefreshBackend.released.set()
+        rate_refresher.wait()
+        assert 1 == RefreshBackend.calls
+
+
+@pytest.mark.django_db(transaction=True)
+def test_refresh_is_skipped_while_another_process_holds_the_lock(stale_source):
+    cache.add(rate_refresher.get_lock_key("refresh-backend"), 1234)
+
+    base_convert_money(10, "USD", "EUR")
+    rate_refresher.wait()
+
+    assert 0 == RefreshBackend.calls
+    # Not attempted again before the retry interval
+    assert rate_refresher.schedule("refresh-backend") is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_failed_refresh_is_logged_and_not_retried_at_once(stale_source, mocker):
+    logger = mocker.patch("djmoney_rates.refresh.logger")
+    mocker.patch.object(RefreshBackend, "get_rates", side_effect=ValueError("provider down"))
+
+    base_convert_money(10, "USD", "EUR")
+    rate_refresher.wait()
+    base_convert_money(10, "USD", "EUR")
+
+    assert logger.exception.called
+    assert 1 == RefreshBackend.get_rates.call_count
+    assert Decimal("7.40") == base_convert_money(10, "USD", "EUR")
@@ -0,0 +1,41 @@
+from __future__ import unicode_literals
+
+import pytest
+
+from django.test import override_settings
+
+from djmoney_rates.backends import OpenExchangeBackend
+from djmoney_rates.settings import DEFAULTS, IMPORT_STRINGS, MANDATORY, MoneyRatesSettings, money_rates_settings
+
+
+def test_settings_follow_override_settings():
+    assert 60 == money_rates_settings.RATE_CACHE_CHECK_INTERVAL
+
+    with override_settings(DJANGO_MONEY_RATES={"RATE_CACHE_CHECK_INTERVAL": 5}):
+        assert 5 == money_rates_settings.RATE_CACHE_CHECK_INTERVAL
+
+    assert 60 == money_rates_settings.RATE_CACHE_CHECK_INTERVAL
+
+
+def test_assigned_settings_are_kept_until_reload():
+    money_rates_settings.RATE_CACHE_CHECK_INTERVAL = 5
+    assert 5 == money_rates_settings.RATE_CACHE_CHECK_INTERVAL
+
+    money_rates_settings.reload()
+    assert 60 == money_rates_settings.RATE_CACHE_CHECK_INTERVAL
+
+
+def test_import_strings_are_resolved_on_access():
+    money_settings = MoneyRatesSettings({"DEFAULT_BACKEND": "djmoney_rates.backends.OpenExchangeBackend",
+                                         "METRICS_CALLBACK": "fake.module.callback"},
+                                        DEFAULTS, IMPORT_STRINGS, MANDATORY)
+
+    assert OpenExchangeBackend is money_settings.DEFAULT_BACKEND
+    assert "DEFAULT_BACKEND" in vars(money_settings)
+
+    with pytest.raises(ImportError) as exc:
+        money_settings.METRICS_CALLBACK
+    assert "Could not import 'fake.module.callback' for setting 'METRICS_CALLBACK'" in str(exc.value)
+
+    with pytest.raises(AttributeError):
+        money_settings.UNKNOWN_SETTING
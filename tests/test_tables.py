@@ -0,0 +1,148 @@
+from __future__ import unicode_literals
+
+import pickle
+from decimal import (
+    ROUND_05UP, ROUND_CEILING, ROUND_DOWN, ROUND_FLOOR, ROUND_HALF_DOWN, ROUND_HALF_EVEN, ROUND_HALF_UP, ROUND_UP,
+    Decimal, InvalidOperation)
+
+import pytest
+from hypothesis import example, given, strategies as st
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from djmoney_rates.exceptions import CurrencyConversionException
+from djmoney_rates.models import Rate, RateSource
+from djmoney_rates.settings import money_rates_settings
+from djmoney_rates.tables import RateTable, convert_amount, get_decimal_places, get_quantum
+
+
+@pytest.fixture
+def table():
+    return RateTable("fake-backend", 1, "USD", None,
+                     {"PLN": Decimal("3.07"), "EUR": Decimal("0.74"), "USD": Decimal(1)})
+
+
+def test_rates_lookup(table):
+    assert Decimal("3.07") == table.rate("PLN")
+    assert ("EUR", "PLN", "USD") == table.currencies
+    assert 3 == len(table)
+    assert "EUR" in table
+    assert "JPY" not in table
+
+    with pytest.raises(CurrencyConversionException) as cm:
+        table.rate("JPY")
+
+    assert "Rate for JPY in fake-backend do not exists" in str(cm.value)
+
+
+def test_conversion(table):
+    assert Decimal("2.41") == table.convert(10.0, "PLN", "EUR")
+    assert [Decimal("2.41"), Decimal("0.24")] == table.convert_many([10, Decimal("1")], "PLN", "EUR")
+
+
+def test_table_is_immutable(table):
+    with pytest.raises(AttributeError):
+        table.base_currency = "EUR"
+
+    with pytest.raises(AttributeError):
+        table.extra = 1
+
+
+def test_table_pickles(table):
+    data = pickle.dumps(table, pickle.HIGHEST_PROTOCOL)
+
+    assert table == pickle.loads(data)
+    assert Decimal("3.07") == pickle.loads(data).rate("PLN")
+
+
+@pytest.mark.django_db(transaction=True)
+def test_table_from_source():
+    source = RateSource.objects.create(name="fake-backend", base_currency="USD")
+    Rate.objects.create(source=source, currency="PLN", value=Decimal("3.07"))
+
+    with CaptureQueriesContext(connection) as ctx:
+        table = RateTable.from_source(source)
+
+    assert 1 == len(ctx.captured_queries)
+    assert (("PLN", Decimal("3.07")),) == tuple(table.items())
+
+
+rates = st.integers(min_value=1, max_value=10 ** 14).map(lambda value: Decimal(value).scaleb(-6))
+
+
+@given(amount=st.integers(min_value=-10 ** 18, max_value=10 ** 18), rate_from=rates, rate_to=rates,
+       currency_from=st.sampled_from(["EUR", "JPY", "KWD"]), currency_to=st.sampled_from(["PLN", "KRW", "BHD"]),
+       rounding=st.sampled_from([ROUND_HALF_EVEN, ROUND_HALF_UP, ROUND_HALF_DOWN, ROUND_DOWN, ROUND_UP,
+                                 ROUND_FLOOR, ROUND_CEILING, ROUND_05UP]))
+@example(amount=1, rate_from=Decimal(3), rate_to=Decimal("4.5"), currency_from="EUR", currency_to="PLN",
+         rounding=ROUND_HALF_EVEN)
+@example(amount=10 ** 18, rate_from=Decimal("0.000001"), rate_to=Decimal(10 ** 8), currency_from="EUR",
+         currency_to="PLN", rounding=ROUND_HALF_EVEN)
+def test_minor_units_conversion_matches_decimal_conversion(amount, rate_from, rate_to, currency_from, currency_to,
+                                                           rounding):
+    table = RateTable("fake-backend", 1, "USD", None, {currency_from: rate_from, currency_to: rate_to})
+    money_rates_settings.ROUNDING = rounding
+
+    try:
+        amount_from = Decimal(amount).scaleb(-get_decimal_places(currency_from))
+        try:
+            expected = convert_amount(amount_from, rate_from, rate_to, currency_to)
+        except InvalidOperation:
+            # The result doesn't fit the precision of the Decimal context
+            with pytest.raises(InvalidOperation):
+                table.convert_minor_units(amount, currency_from, currency_to)
+            return
+
+        result = table.convert_minor_units(amount, currency_from, currency_to)
+        assert Decimal(result).scaleb(-get_decimal_places(currency_to)) == expected
+    finally:
+        money_rates_settings.ROUNDING = ROUND_HALF_EVEN
+
+
+def test_minor_units_conversion_near_ties(table):
+    # 0.01 / 3 * 4.5 is a tie, left to the Decimal path
+    table = RateTable("fake-backend", 1, "USD", None, {"EUR": Decimal(3), "PLN": Decimal("4.5")})
+    amounts = [1, -1, 3, 10]
+    assert [int(table.convert(Decimal(amount).scaleb(-2), "EUR", "PLN").scaleb(2)) for amount in amounts] == \
+        table.convert_minor_units_many(amounts, "EUR", "PLN")
+
+
+def test_minor_units_conversion(table):
+    assert 241 == table.convert_minor_units(1000, "PLN", "EUR")
+    assert 307 == table.convert_minor_units(100, "USD", "PLN")
+
+    with pytest.raises(CurrencyConversionException):
+        table.convert_minor_units(100, "USD", "JPY")
+
+
+def test_amounts_are_quantized_for_the_target_currency():
+    table = RateTable("fake-backend", 1, "USD", None,
+                      {"JPY": Decimal("113.5"), "KWD": Decimal("0.301234"), "EUR": Decimal("0.74")})
+
+    assert Decimal("1") == get_quantum("JPY")
+    assert Decimal("0.001") == get_quantum("KWD")
+    assert Decimal("0.01") == get_quantum("EUR")
+
+    assert Decimal("1135") == table.convert(10, "USD", "JPY")
+    assert Decimal("3.012") == table.convert(10, "USD", "KWD")
+    assert Decimal("0.07") == table.convert(10, "JPY", "EUR")
+    assert 1135 == table.convert_minor_units(1000, "USD", "JPY")
+    assert 3012 == table.convert_minor_units(1000, "USD", "KWD")
+
+
+def test_decimal_places_and_rounding_can_be_configured():
+    table = RateTable("fake-backend", 1, "USD", None, {"EUR": Decimal("0.745"), "JPY": Decimal("113.5")})
+    assert Decimal("0.74") == table.convert(1, "USD", "EUR")
+
+    money_rates_settings.ROUNDING = ROUND_HALF_UP
+    money_rates_settings.CURRENCY_DECIMAL_PLACES = {"JPY": 2}
+    try:
+        assert Decimal("0.75") == table.convert(1, "USD", "EUR")
+        assert Decimal("113.50") == table.convert(1, "USD", "JPY")
+        assert 11350 == table.convert_minor_units(100, "USD", "JPY")
+    finally:
+        money_rates_settings.ROUNDING = ROUND_HALF_EVEN
+        money_rates_settings.CURRENCY_DECIMAL_PLACES = {}
+
+    assert Decimal("114") == table.convert(1, "USD", "JPY")
@@ -1,14 +1,19 @@
 from __future__ import unicode_literals
 
+import itertools
 from decimal import Decimal
 
 import pytest
 
+from django.test import override_settings
+
 from djmoney_rates.backends import BaseRateBackend
 from djmoney_rates.exceptions import CurrencyConversionException
 from djmoney_rates.models import RateSource, Rate
 from djmoney_rates.settings import money_rates_settings
-from djmoney_rates.utils import base_convert_money, convert_money
+from djmoney_rates.utils import (
+    base_convert_minor_units, base_convert_money, convert_minor_units_many, convert_money, convert_money_many,
+    get_source_descriptor, iter_convert)
 
 import moneyed
 
@@ -108,3 +113,129 @@ def test_conversion_is_working_from_other_currency(set_up):
 
     amount = convert_money(10.0, "PLN", "EUR")
     assert amount == moneyed.Money(Decimal("2.41"), "EUR")
+
+@pytest.mark.django_db(transaction=True)
+def test_convert_money_many_matches_base_convert_money(set_up):
+    source = RateSource.objects.create(name="fake-backend", base_currency="USD")
+    Rate.objects.create(source=source, currency="USD", value=1)
+    Rate.objects.create(source=source, currency="PLN", value=3.07)
+    Rate.objects.create(source=source, currency="EUR", value=0.74)
+
+    amounts = [10.0, 1, Decimal("0.015"), 123456.789, Decimal("-7.5")]
+    currencies_from = ["PLN", "USD", "EUR", "PLN", "USD"]
+
+    amounts_to = convert_money_many(amounts, currencies_from, "EUR", as_decimal=True)
+    assert amounts_to == [base_convert_money(amount, currency, "EUR")
+                          for amount, currency in zip(amounts, currencies_from)]
+
+    moneys = convert_money_many(amounts, "USD", ["EUR", "PLN", "USD", "EUR", "PLN"])
+    assert moneys[1] == moneyed.Money(Decimal("3.07"), "PLN")
+    assert moneys == [convert_money(amount, "USD", currency)
+                      for amount, currency in zip(amounts, ["EUR", "PLN", "USD", "EUR", "PLN"])]
+
+@pytest.mark.django_db(transaction=True)
+def test_minor_units_conversion_matches_base_convert_money(set_up):
+    source = RateSource.objects.create(name="fake-backend", base_currency="USD")
+    Rate.objects.create(source=source, currency="USD", value=1)
+    Rate.objects.create(source=source, currency="PLN", value=3.07)
+    Rate.objects.create(source=source, currency="EUR", value=0.74)
+
+    amounts = [1000, 1, -750, 12345678]
+    assert 241 == base_convert_minor_units(1000, "PLN", "EUR")
+    assert [Decimal(amount).scaleb(-2) for amount in convert_minor_units_many(amounts, "USD", "PLN")] == \
+        [base_convert_money(Decimal(amount) / 100, "USD", "PLN") for amount in amounts]
+
+    with pytest.raises(CurrencyConversionException):
+        base_convert_minor_units(100, "USD", "BRL")
+
+
+@pytest.mark.django_db(transaction=True)
+def test_conversion_is_rounded_for_the_target_currency(set_up):
+    source = RateSource.objects.create(name="fake-backend", base_currency="USD")
+    Rate.objects.create(source=source, currency="JPY", value=113.57)
+    Rate.objects.create(source=source, currency="KWD", value=0.301234)
+
+    assert moneyed.Money(Decimal("1136"), "JPY") == convert_money(10, "USD", "JPY")
+    assert Decimal("3.012") == base_convert_money(10, "USD", "KWD")
+    assert [Decimal("1136"), Decimal("2.652")] == \
+        convert_money_many([10, 1000], ["USD", "JPY"], ["JPY", "KWD"], as_decimal=True)
+
+    money_rates_settings.CROSS_RATES_ENABLED = True
+    try:
+        assert Decimal("1136") == base_convert_money(10, "USD", "JPY")
+    finally:
+        money_rates_settings.CROSS_RATES_ENABLED = False
+
+
+@pytest.mark.django_db(transaction=True)
+def test_iter_convert_streams_rows_with_the_same_rates(set_up):
+    source = RateSource.objects.create(name="fake-backend", base_currency="USD")
+    Rate.objects.create(source=source, currency="PLN", value=3.07)
+    eur = Rate.objects.create(source=source, currency="EUR", value=0.74)
+
+    consumed = []
+
+    def rows():
+        for i in itertools.count():
+            consumed.append(i)
+            yield {"amount": Decimal(10), "currency": "PLN" if i % 2 else "USD"}
+
+    converted = iter_convert(rows(), "EUR", key=lambda row: (row["amount"], row["currency"]), chunk_size=3)
+    assert (Decimal("7.40"), Decimal("2.41")) == (next(converted)[1], next(converted)[1])
+    assert 3 == len(consumed)
+
+    eur.value = 1
+    eur.save()
+
+    assert [Decimal("7.40"), Decimal("2.41")] == [amount for row, amount in itertools.islice(converted, 2)]
+    assert 6 == len(consumed)
+    assert [((Decimal(1), "USD"), Decimal("1.00"))] == list(iter_convert([(Decimal(1), "USD")], "EUR"))
+
+
+def test_iter_convert_rejects_empty_chunks():
+    for chunk_size in (0, -1):
+        with pytest.raises(ValueError):
+            iter_convert([(Decimal(1), "USD")], "EUR", chunk_size=chunk_size)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_convert_money_many_fail_when_currency_does_not_exist(set_up):
+    source = RateSource.objects.create(name="fake-backend", base_currency="USD")
+    Rate.objects.create(source=source, currency="EUR", value=0.74)
+
+    with pytest.raises(CurrencyConversionException) as cm:
+        convert_money_many([1, 2], ["USD", "PLN"], "EUR")
+
+    assert "Rate for PLN in fake-backend do not exists" in str(cm.value)
+
+@pytest.mark.django_db(transaction=True)
+def test_default_backend_is_instantiated_once():
+    class RateBackend(BaseRateBackend):
+        source_name = "fake-backend"
+        base_currency = "USD"
+        instances = 0
+
+        def __init__(self):
+            RateBackend.instances += 1
+
+    money_rates_settings.DEFAULT_BACKEND = RateBackend
+    source = RateSource.objects.create(name="fake-backend", base_currency="USD")
+    Rate.objects.create(source=source, currency="EUR", value=0.74)
+
+    base_convert_money(1, "USD", "EUR")
+    base_convert_money(2, "USD", "EUR")
+
+    assert 1 == RateBackend.instances
+    assert get_source_descriptor() == ("fake-backend", "USD")
+
+def test_source_descriptor_follows_default_backend():
+    class RateBackend(BaseRateBackend):
+        source_name = "another-backend"
+        base_currency = "EUR"
+
+    money_rates_settings.DEFAULT_BACKEND = RateBackend
+    assert "another-backend" == get_source_descriptor().name
+
+    with override_settings(DJANGO_MONEY_RATES={"DEFAULT_BACKEND": RateBackend}):
+        RateBackend.source_name = "renamed-backend"
+        assert "renamed-backend" == get_source_descriptor().name